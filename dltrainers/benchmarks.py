@@ -0,0 +1,423 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Throughput benchmarks for trainers and layers.
+
+Run with `python -m dltrainers.benchmarks` (or `./run-benchmarks`).
+Each benchmark reports samples per second, per-step latency, the time
+spent in each trainer stage, the rise in peak memory during the
+benchmark, and buffer allocations.
+Results can be written as JSON and compared against a stored
+baseline.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+from torch import nn
+from torch.autograd import Variable
+import trainers
+import layers
+import flex
+import profiling
+import buckets
+import readers
+import export
+import helpers as dlh
+
+def _status_mb(field):
+    """A memory field of /proc/self/status (e.g. "VmRSS") in MB, or None."""
+    try:
+        with open("/proc/self/status") as stream:
+            for line in stream:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return None
+
+def _lifetime_peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def start_rss():
+    """Start measuring the memory of a benchmark; returns the RSS in MB.
+
+    On Linux, the peak RSS of the process is reset first, so that
+    `peak_rss_mb` only sees the benchmark. Elsewhere, the lifetime
+    peak so far is returned instead of the current RSS.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as stream:
+            stream.write("5")
+    except (IOError, OSError):
+        return _lifetime_peak_mb()
+    return _status_mb("VmRSS") or 0.0
+
+def peak_rss_mb(start):
+    """The rise of the peak RSS over start (from `start_rss`) in MB.
+
+    Without a resettable peak, this is the rise of the lifetime peak,
+    which is 0 for benchmarks that stay below an earlier one.
+    """
+    peak = _status_mb("VmHWM")
+    if peak is None:
+        peak = _lifetime_peak_mb()
+    return max(0.0, peak - start)
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if len(values) > 0 else 0.0
+
+def _train(trainer, batch):
+    """Train on an (inputs, targets) pair or a train_for style batch dict."""
+    if isinstance(batch, dict):
+        trainer.set_batch_info(batch)
+        batch = (batch[trainer.input_name], batch[trainer.output_name])
+    trainer.train_batch(*batch)
+    return len(batch[0])
+
+def bench_trainer(name, trainer, batches, warmup=2):
+    """Time train_batch over (inputs, targets) pairs or batch dicts."""
+    batches = list(batches)
+    rss = start_rss()
+    for batch in batches[:warmup]:
+        _train(trainer, batch)
+    trainer.set_profiling(timer=profiling.synchronized_timer if trainer.use_cuda else None)
+    allocs = trainer.buffers.nalloc
+    trainer.copies.reset()
+    latencies = []
+    nsamples = 0
+    start = time.time()
+    for batch in batches[warmup:]:
+        step_start = time.time()
+        nsamples += _train(trainer, batch)
+        latencies.append(time.time() - step_start)
+    total = time.time() - start
+    stages = trainer.profiler.summary()
+    trainer.set_profiling(False)
+    return dict(name=name,
+                samples_per_sec=nsamples / total,
+                step_ms_mean=1000.0 * total / len(latencies),
+                step_ms_p50=1000.0 * percentile(latencies, 50),
+                step_ms_p90=1000.0 * percentile(latencies, 90),
+                stages_ms=dict((k, 1000.0 * v["mean"]) for k, v in stages.items()),
+                buffer_allocs=trainer.buffers.nalloc - allocs,
+                copied_bytes_per_step=trainer.copies.total_bytes() / float(len(latencies)),
+                peak_rss_mb=peak_rss_mb(rss))
+
+def bench_layer(name, module, make_input, nbatches=10, warmup=2):
+    """Time forward and backward passes of a layer."""
+    rss = start_rss()
+    x = make_input()
+    latencies = []
+    forward_time = 0.0
+    for i in range(warmup + nbatches):
+        start = time.time()
+        v = Variable(x, requires_grad=True)
+        y = module(v)
+        mid = time.time()
+        y.backward(torch.ones(*y.size()).type_as(y.data))
+        if i >= warmup:
+            latencies.append(time.time() - start)
+            forward_time += mid - start
+    total = sum(latencies)
+    return dict(name=name,
+                samples_per_sec=x.size(0) * nbatches / total,
+                step_ms_mean=1000.0 * total / nbatches,
+                step_ms_p50=1000.0 * percentile(latencies, 50),
+                step_ms_p90=1000.0 * percentile(latencies, 90),
+                stages_ms=dict(forward=1000.0 * forward_time / nbatches,
+                               backward=1000.0 * (total - forward_time) / nbatches),
+                buffer_allocs=0,
+                peak_rss_mb=peak_rss_mb(rss))
+
+def synthetic_batches(nbatches, make):
+    return [make() for _ in range(nbatches)]
+
+def load_sample_db(fname, limit=1000):
+    """Read and decode images and classes from a sample.db style file."""
+    import PIL.Image
+    db = sqlite3.connect(fname)
+    rows = db.execute("select image, cls from train order by inx limit ?",
+                      (limit,)).fetchall()
+    images = [np.asarray(PIL.Image.open(io.BytesIO(bytes(image))), "f") / 255.0
+              for image, _ in rows]
+    classes = [cls for _, cls in rows]
+    return np.array(images, "f"), np.array(classes, "int64")
+
+def classifier_model():
+    return nn.Sequential(flex.Conv2d(16, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+                         flex.Conv2d(32, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+                         layers.Flat(), flex.Linear(10), nn.Sigmoid())
+
+def trainer_benchmarks(bs=32, nbatches=10, db=None):
+    results = []
+    make = lambda: (torch.randn(bs, 100), torch.randn(bs, 10))
+    model = nn.Sequential(nn.Linear(100, 200), nn.ReLU(), nn.Linear(200, 10))
+    results.append(bench_trainer("BasicTrainer/synthetic",
+                                 trainers.BasicTrainer(model, use_cuda=False),
+                                 synthetic_batches(nbatches, make)))
+    make = lambda: (np.random.rand(bs, 28, 28, 1).astype("f"),
+                    np.random.randint(0, 10, size=bs))
+    tr = trainers.ImageClassifierTrainer(classifier_model(), use_cuda=False,
+                                         input_shape=(bs, 1, 28, 28))
+    results.append(bench_trainer("ImageClassifierTrainer/synthetic", tr,
+                                 synthetic_batches(nbatches, make)))
+    if db is not None:
+        images, classes = load_sample_db(db, limit=bs * (nbatches + 2))
+        batches = [(images[i:i+bs, :, :, np.newaxis], classes[i:i+bs])
+                   for i in range(0, len(images) - bs + 1, bs)]
+        tr = trainers.ImageClassifierTrainer(classifier_model(), use_cuda=False,
+                                             input_shape=(bs, 1, 28, 28))
+        results.append(bench_trainer("ImageClassifierTrainer/sample.db", tr, batches))
+    make = lambda: (np.random.rand(bs, 64, 64, 1).astype("f"),
+                    np.random.rand(bs, 32, 32, 4).astype("f"))
+    model = nn.Sequential(flex.Conv2d(16, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+                          flex.Conv2d(4, 3, padding=1), nn.Sigmoid())
+    tr = trainers.Image2ImageTrainer(model, use_cuda=False, input_shape=(bs, 1, 64, 64))
+    results.append(bench_trainer("Image2ImageTrainer/synthetic", tr,
+                                 synthetic_batches(nbatches, make)))
+    tr = trainers.Image2SeqTrainer(seq_model(), use_cuda=False, input_shape=(bs, 1, 100, 28))
+    results.append(bench_trainer("Image2SeqTrainer/synthetic", tr,
+                                 synthetic_batches(nbatches, lambda: seq_batch(bs))))
+    if torch.cuda.is_available():
+        for precision in ("float32", "float16"):
+            tr = trainers.Image2SeqTrainer(seq_model(), use_cuda=True,
+                                           input_shape=(bs, 1, 100, 28))
+            tr.set_precision(None if precision == "float32" else precision)
+            results.append(bench_trainer("Image2SeqTrainer/cuda/" + precision, tr,
+                                         synthetic_batches(nbatches, lambda: seq_batch(bs))))
+    return results
+
+def seq_model():
+    return nn.Sequential(flex.Conv2d(8, 3, padding=1), nn.ReLU(), layers.Img2Seq(),
+                         flex.Lstm1(32), flex.Conv1d(11, 1))
+
+def seq_batch(bs):
+    """A batch of random 100x28 images with 10-character targets."""
+    targets = np.zeros((bs, 11, 21), "f")
+    targets[:, 0, 0::2] = 1.0
+    labels = np.random.randint(1, 11, size=(bs, 10))
+    for i in range(bs):
+        targets[i, labels[i], np.arange(1, 21, 2)] = 1.0
+    return np.random.rand(bs, 100, 28, 1).astype("f"), targets
+
+def _parallel_run(nprocs, bs, nbatches, results):
+    tr = trainers.Image2SeqTrainer(seq_model(), use_cuda=False, input_shape=(bs, 1, 100, 28))
+    tr.set_data_parallel(nprocs)
+    try:
+        results.put(bench_trainer("Image2SeqTrainer/parallel-{}".format(nprocs), tr,
+                                  synthetic_batches(nbatches, lambda: seq_batch(bs))))
+    finally:
+        tr.set_data_parallel(None)
+
+def parallel_benchmarks(bs=32, nbatches=10, procs=(1, 2, 4)):
+    """Data-parallel throughput and scaling efficiency for each process count.
+
+    Efficiency is the speedup over procs[0] processes divided by the
+    increase in process count. Each setting runs in a fresh process,
+    since a process can only join one process group.
+    """
+    results = []
+    for nprocs in procs:
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_parallel_run,
+                                       args=(nprocs, bs, nbatches, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+    base = results[0]["samples_per_sec"] / procs[0]
+    for nprocs, r in zip(procs, results):
+        r["scaling_efficiency"] = r["samples_per_sec"] / (base * nprocs)
+    return results
+
+def variable_width_samples(n, d=11, h=28, lo=20, hi=200):
+    """Random text-line-like samples of widths between lo and hi."""
+    samples = []
+    for _ in range(n):
+        w = np.random.randint(lo, hi + 1)
+        nlabels = max(1, w // 10)
+        target = np.zeros((d, 2 * nlabels + 1), "f")
+        target[0, 0::2] = 1.0
+        target[np.random.randint(1, d, size=nlabels), np.arange(1, 2 * nlabels + 1, 2)] = 1.0
+        samples.append(dict(input=np.random.rand(w, h, 1).astype("f"), output=target))
+    return samples
+
+def variable_width_benchmarks(bs=32, nbatches=10):
+    """Compare padding to the widest sample with length-bucketed batches."""
+    samples = variable_width_samples(bs * (nbatches + 2))
+    results = []
+    ordered = list(buckets.bucketed_batches(samples, bs, shuffle=False))
+    random.shuffle(samples)
+    for name, batches in (("padded", [buckets.pad_batch(samples[i:i+bs])
+                                      for i in range(0, len(samples), bs)]),
+                          ("bucketed", ordered)):
+        padding = buckets.padding_fraction(batches)
+        if name == "padded":
+            batches = [(b["input"], b["output"]) for b in batches]
+        tr = trainers.Image2SeqTrainer(seq_model(), use_cuda=False,
+                                       input_shape=(bs, 1, 100, 28))
+        result = bench_trainer("Image2SeqTrainer/variable-width/" + name, tr, batches)
+        result["padding_fraction"] = padding
+        results.append(result)
+    return results
+
+def reader_benchmarks(db, bs=32, workers=(0, 4)):
+    """Throughput of reading and decoding batches with SqliteReader."""
+    results = []
+    for n in workers:
+        rss = start_rss()
+        reader = readers.SqliteReader(db, batch_size=bs, workers=n, seed=0)
+        latencies = []
+        nsamples = 0
+        start = last = time.time()
+        for batch in reader:
+            now = time.time()
+            latencies.append(now - last)
+            last = now
+            nsamples += len(batch["cls"])
+        total = time.time() - start
+        results.append(dict(name="SqliteReader/workers-{}".format(n),
+                            samples_per_sec=nsamples / total,
+                            step_ms_mean=1000.0 * total / max(1, len(latencies)),
+                            step_ms_p50=1000.0 * percentile(latencies, 50),
+                            step_ms_p90=1000.0 * percentile(latencies, 90),
+                            stages_ms={}, buffer_allocs=0, peak_rss_mb=peak_rss_mb(rss)))
+    return results
+
+def _serving_result(name, load, x, nbatches):
+    """Cold start (load plus first batch) and per-batch latency of a model."""
+    rss = start_rss()
+    start = time.time()
+    model = load()
+    with dlh.no_grad():
+        model(x)
+        cold = time.time() - start
+        latencies = []
+        for _ in range(nbatches):
+            step_start = time.time()
+            model(x)
+            latencies.append(time.time() - step_start)
+    total = sum(latencies)
+    return dict(name=name,
+                samples_per_sec=x.size(0) * nbatches / total,
+                step_ms_mean=1000.0 * total / nbatches,
+                step_ms_p50=1000.0 * percentile(latencies, 50),
+                step_ms_p90=1000.0 * percentile(latencies, 90),
+                cold_start_ms=1000.0 * cold,
+                stages_ms={}, buffer_allocs=0, peak_rss_mb=peak_rss_mb(rss))
+
+def export_benchmarks(bs=32, nbatches=10):
+    """Compare the eager classifier with its TorchScript export."""
+    if not hasattr(torch, "jit") or not hasattr(torch.jit, "trace"):
+        return []
+    directory = tempfile.mkdtemp()
+    try:
+        shape = (bs, 1, 28, 28)
+        eager_path = os.path.join(directory, "eager.pt")
+        script_path = os.path.join(directory, "model.pt")
+        model = classifier_model()
+        flex.flex_build(model, shape)
+        model.eval()
+        torch.save(model, eager_path)
+        export.export_model(model, shape, script_path)
+        x = torch.rand(*shape)
+        return [_serving_result("Export/eager", lambda: torch.load(eager_path).eval(),
+                                x, nbatches),
+                _serving_result("Export/torchscript", lambda: torch.jit.load(script_path),
+                                x, nbatches)]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def layer_benchmarks(bs=16, nbatches=10):
+    results = []
+    results.append(bench_layer("LSTM1", layers.LSTM1(32, 64),
+                               lambda: torch.randn(bs, 32, 200), nbatches))
+    results.append(bench_layer("LSTM2", layers.LSTM2(8, 16),
+                               lambda: torch.randn(bs, 8, 32, 32), nbatches))
+    results.append(bench_layer("RowwiseLSTM", layers.RowwiseLSTM(8, 16),
+                               lambda: torch.randn(bs, 8, 32, 32), nbatches))
+    strips = layers.LSTM2(8, 16)
+    strips.set_strips(8)
+    results.append(bench_layer("LSTM2/strips", strips,
+                               lambda: torch.randn(bs, 8, 32, 32), nbatches))
+    results.append(bench_layer("Img2Seq", layers.Img2Seq(),
+                               lambda: torch.randn(bs, 16, 200, 32), nbatches))
+    results.append(bench_layer("Reorder", layers.Reorder("BDL", "LBD"),
+                               lambda: torch.randn(bs, 64, 400), nbatches))
+    return results
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare results with a baseline; returns a list of report lines.
+
+    A benchmark counts as a regression if its throughput dropped by
+    more than `tolerance` (relative).
+    """
+    baseline = dict((r["name"], r) for r in baseline)
+    report = []
+    for r in results:
+        b = baseline.get(r["name"])
+        if b is None:
+            report.append("{:40s} (no baseline)".format(r["name"]))
+            continue
+        ratio = r["samples_per_sec"] / b["samples_per_sec"]
+        status = "REGRESSION" if ratio < 1.0 - tolerance else "ok"
+        report.append("{:40s} {:8.3f}x {}".format(r["name"], ratio, status))
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dltrainers trainers and layers.")
+    parser.add_argument("--batchsize", type=int, default=32)
+    parser.add_argument("--nbatches", type=int, default=10)
+    parser.add_argument("--db", default="testdata/sample.db",
+                        help="sample.db style file for data benchmarks ('' to skip)")
+    parser.add_argument("--only", default=None, help="run only 'trainers' or 'layers'")
+    parser.add_argument("--parallel", default=None,
+                        help="comma-separated process counts for data-parallel scaling")
+    parser.add_argument("--output", default=None, help="write JSON results here")
+    parser.add_argument("--baseline", default=None, help="compare with JSON results")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+    results = []
+    if args.only in (None, "trainers"):
+        results += trainer_benchmarks(args.batchsize, args.nbatches, args.db or None)
+        results += variable_width_benchmarks(args.batchsize, args.nbatches)
+        if args.db:
+            results += reader_benchmarks(args.db, args.batchsize)
+        results += export_benchmarks(args.batchsize, args.nbatches)
+    if args.only in (None, "layers"):
+        results += layer_benchmarks(args.batchsize // 2, args.nbatches)
+    if args.parallel:
+        procs = [int(p) for p in args.parallel.split(",")]
+        results += parallel_benchmarks(args.batchsize, args.nbatches, procs)
+    for r in results:
+        print("{:40s} {:10.1f} samples/s {:8.2f} ms/step".format(
+            r["name"], r["samples_per_sec"], r["step_ms_mean"]))
+        if "cold_start_ms" in r:
+            print("{:40s} {:10.1f} ms cold start".format("", r["cold_start_ms"]))
+        if "scaling_efficiency" in r:
+            print("{:40s} {:10.2f} scaling efficiency".format("", r["scaling_efficiency"]))
+    if args.output is not None:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as stream:
+            report = compare(results, json.load(stream), args.tolerance)
+        for line in report:
+            print(line)
+        if any(line.endswith("REGRESSION") for line in report):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Length-bucketed batching of variable-width samples.
+
+`bucketed_batches` reads samples (dicts with an image and, optionally,
+a target sequence) from an iterator, groups samples of similar width,
+and yields padded batches in the format used by `train_for`. Each
+batch also has "lengths" and "target_lengths" fields with the unpadded
+sizes, which `Image2SeqTrainer` uses to ignore the padding.
+"""
+
+import random
+import numpy as np
+
+def sample_length(sample, name, axis=0):
+    return np.asarray(sample[name]).shape[axis]
+
+def pad_stack(arrays, axis, fill=None):
+    """Stack arrays, padding them with zeros along axis to the longest.
+
+    `fill` is an optional function called on each padded region.
+    """
+    arrays = [np.asarray(a) for a in arrays]
+    n = max(a.shape[axis] for a in arrays)
+    shape = list(arrays[0].shape)
+    shape[axis] = n
+    result = np.zeros([len(arrays)] + shape, arrays[0].dtype)
+    for i, a in enumerate(arrays):
+        index = [slice(None)] * a.ndim
+        index[axis] = slice(0, a.shape[axis])
+        result[i][tuple(index)] = a
+        if fill is not None and a.shape[axis] < n:
+            index[axis] = slice(a.shape[axis], n)
+            fill(result[i][tuple(index)])
+    return result
+
+def fill_blank(region):
+    """Fill padded DL target positions with the blank class (0)."""
+    region[0] = 1.0
+
+def pad_batch(samples, input_name="input", output_name="output",
+              axis=0, target_axis=1):
+    """Combine samples into a padded batch.
+
+    Inputs are padded with zeros along `axis`, and targets (DL arrays)
+    with blanks along `target_axis`.
+    """
+    batch = {}
+    batch[input_name] = pad_stack([s[input_name] for s in samples], axis)
+    batch["lengths"] = np.array([sample_length(s, input_name, axis)
+                                 for s in samples], "int64")
+    if all(output_name in s for s in samples):
+        batch[output_name] = pad_stack([s[output_name] for s in samples],
+                                       target_axis, fill=fill_blank)
+        batch["target_lengths"] = np.array([sample_length(s, output_name, target_axis)
+                                            for s in samples], "int64")
+    return batch
+
+def bucketed_batches(source, batch_size, input_name="input", output_name="output",
+                     axis=0, target_axis=1, buffer_size=1024, shuffle=True):
+    """Yield padded batches of samples of similar width.
+
+    Up to `buffer_size` samples are read at a time, sorted by width,
+    and cut into batches; with shuffle=True the batches of each buffer
+    are returned in random order.
+    """
+    assert buffer_size >= batch_size, (buffer_size, batch_size)
+    buffer = []
+    for sample in source:
+        buffer.append(sample)
+        if len(buffer) >= buffer_size:
+            for batch in _buffer_batches(buffer, batch_size, input_name, output_name,
+                                         axis, target_axis, shuffle):
+                yield batch
+            buffer = []
+    for batch in _buffer_batches(buffer, batch_size, input_name, output_name,
+                                 axis, target_axis, shuffle):
+        yield batch
+
+def _buffer_batches(buffer, batch_size, input_name, output_name,
+                    axis, target_axis, shuffle):
+    buffer = sorted(buffer, key=lambda s: sample_length(s, input_name, axis))
+    groups = [buffer[i:i+batch_size] for i in range(0, len(buffer), batch_size)]
+    if shuffle:
+        random.shuffle(groups)
+    for group in groups:
+        yield pad_batch(group, input_name, output_name, axis, target_axis)
+
+def padding_fraction(batches, input_name="input", axis=1):
+    """The fraction of padded frames in a list of padded batches."""
+    total = sum(b[input_name].shape[0] * b[input_name].shape[axis] for b in batches)
+    valid = sum(np.sum(b["lengths"]) for b in batches)
+    return 1.0 - float(valid) / total
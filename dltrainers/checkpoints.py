@@ -0,0 +1,157 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Trainer checkpoints.
+
+A checkpoint is a directory with one .npy file per tensor and a
+pickled `state.pkl` that holds everything else, with references to
+the tensor files. On restore, the tensors are memory-mapped
+(copy-on-write), so only the pages that are actually used are read.
+A `Checkpointer` writes snapshots on a background thread. It names
+checkpoints by `ntrain` and prunes old ones.
+"""
+
+import glob
+import os
+import pickle
+import re
+import shutil
+import threading
+import numpy as np
+import torch
+
+class TensorRef(object):
+    """Placeholder for a tensor stored in a separate .npy file."""
+    def __init__(self, name):
+        self.name = name
+
+def snapshot(obj):
+    """Copy the tensors in a nested structure to the CPU.
+
+    This is what happens in the training loop; the copies can then be
+    written in the background while training continues.
+    """
+    if torch.is_tensor(obj):
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    if isinstance(obj, dict):
+        return obj.__class__((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot(v) for v in obj)
+    return obj
+
+def _externalize(obj, tensors):
+    if torch.is_tensor(obj):
+        ref = TensorRef("t{:05d}".format(len(tensors)))
+        tensors[ref.name] = obj.numpy()
+        return ref
+    if isinstance(obj, dict):
+        return obj.__class__((k, _externalize(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_externalize(v, tensors) for v in obj)
+    return obj
+
+def _internalize(obj, path, mmap):
+    if isinstance(obj, TensorRef):
+        fname = os.path.join(path, obj.name + ".npy")
+        return torch.from_numpy(np.load(fname, mmap_mode="c" if mmap else None))
+    if isinstance(obj, dict):
+        return obj.__class__((k, _internalize(v, path, mmap)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_internalize(v, path, mmap) for v in obj)
+    return obj
+
+def save_state(state, path):
+    """Write a snapshot to the directory path (atomically, via rename)."""
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    tensors = {}
+    meta = _externalize(state, tensors)
+    for name, array in tensors.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+    with open(os.path.join(tmp, "state.pkl"), "wb") as stream:
+        pickle.dump(meta, stream, pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+def load_state(path, mmap=True):
+    """Read a checkpoint written by save_state; tensors are memory-mapped."""
+    with open(os.path.join(path, "state.pkl"), "rb") as stream:
+        meta = pickle.load(stream)
+    return _internalize(meta, path, mmap)
+
+class Checkpointer(object):
+    """Writes checkpoints to a directory in the background and prunes them.
+
+    The newest `keep` checkpoints are kept; with keep_every, so is the
+    newest checkpoint in each interval of keep_every training samples.
+    At most one write is in progress; `save` waits for the previous one.
+    """
+
+    def __init__(self, directory, keep=3, keep_every=None, prefix="checkpoint"):
+        self.directory = directory
+        self.keep = keep
+        self.keep_every = keep_every
+        self.prefix = prefix
+        self.thread = None
+        self.error = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, ntrain):
+        return os.path.join(self.directory, "{}-{:012d}".format(self.prefix, int(ntrain)))
+
+    def checkpoints(self):
+        """Return (ntrain, path) for the complete checkpoints, oldest first."""
+        pattern = re.compile(re.escape(self.prefix) + r"-(\d+)$")
+        result = []
+        for path in glob.glob(os.path.join(self.directory, self.prefix + "-*")):
+            match = pattern.match(os.path.basename(path))
+            if match and os.path.exists(os.path.join(path, "state.pkl")):
+                result.append((int(match.group(1)), path))
+        return sorted(result)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if len(checkpoints) > 0 else None
+
+    def prune(self):
+        checkpoints = self.checkpoints()
+        keep = set(path for _, path in checkpoints[-self.keep:]) if self.keep > 0 else set()
+        if self.keep_every:
+            newest = {}
+            for ntrain, path in checkpoints:
+                newest[ntrain // self.keep_every] = path
+            keep.update(newest.values())
+        for _, path in checkpoints:
+            if path not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _write(self, state, path):
+        try:
+            save_state(state, path)
+            self.prune()
+        except Exception as exn:
+            self.error = exn
+
+    def save(self, state, ntrain, wait=False):
+        """Write a snapshot (see `snapshot`) in the background."""
+        self.wait()
+        path = self.path(ntrain)
+        self.thread = threading.Thread(target=self._write, args=(state, path))
+        self.thread.daemon = True
+        self.thread.start()
+        if wait:
+            self.wait()
+        return path
+
+    def wait(self):
+        """Wait for the pending write; raises its error, if any."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,242 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Batched CTC alignment.
+
+This is a native replacement for `cctc.ctc_align_targets_batch`. Given
+a batch of output probabilities and a batch of target sequences (both
+BLD, with blanks already present in the targets), it computes the
+forward-backward alignment in log space and returns the aligned
+targets, again BLD. The computation is vectorized over the batch and
+the target positions and only loops over time steps.
+"""
+
+import time
+import multiprocessing
+import numpy as np
+import torch
+import helpers
+
+_pool = None
+_pool_size = None
+
+def reverse(x, dim):
+    """Reverse a tensor along dimension dim."""
+    n = x.size(dim)
+    index = torch.arange(n - 1, -1, -1).long()
+    if x.is_cuda:
+        index = index.cuda(x.get_device())
+    return x.index_select(dim, index)
+
+def log_add(a, b):
+    """Compute log(exp(a) + exp(b)) elementwise."""
+    m = torch.max(a, b)
+    return m + ((a - m).exp() + (b - m).exp()).log()
+
+def forward_algorithm(lmatch, skip=-5.0):
+    """Run the forward algorithm over a batch of log match matrices.
+
+    `lmatch` is (b, l, lt); the result has the same shape and contains
+    the log forward probabilities for each time step and target position.
+    """
+    b, l, lt = lmatch.size()
+    result = lmatch.new(b, l, lt)
+    v = (torch.arange(0, lt) * skip).type_as(lmatch)
+    v = v.unsqueeze(0).expand(b, lt).contiguous()
+    w = lmatch.new(b, lt)
+    for i in range(l):
+        w[:, 0] = skip * i
+        if lt > 1:
+            w[:, 1:] = v[:, :-1]
+        v = log_add(w, v) + lmatch[:, i]
+        result[:, i] = v
+    return result
+
+def as_lengths(lengths, n, like):
+    """Convert a list/array/tensor of lengths to a LongTensor on like's device."""
+    if lengths is None:
+        lengths = [n] * like.size(0)
+    lengths = torch.LongTensor(np.asarray(lengths, "int64"))
+    if like.is_cuda:
+        lengths = lengths.cuda(like.get_device())
+    return lengths
+
+def valid_mask(lengths, n):
+    """A (b, n) mask that is 1 for the first lengths[i] positions of row i."""
+    b = lengths.size(0)
+    positions = torch.arange(0, n).type_as(lengths).unsqueeze(0).expand(b, n)
+    return positions.lt(lengths.unsqueeze(1).expand(b, n))
+
+def reverse_valid(lengths, n):
+    """Indexes reversing the first lengths[i] positions of each row.
+
+    Positions past the length keep their place; the map is its own
+    inverse.
+    """
+    b = lengths.size(0)
+    positions = torch.arange(0, n).type_as(lengths).unsqueeze(0).expand(b, n)
+    last = (lengths - 1).unsqueeze(1).expand(b, n)
+    mask = valid_mask(lengths, n).type_as(lengths)
+    return mask * (last - positions) + (1 - mask) * positions
+
+def ctc_align_targets_batch(probs, targets, lo=1e-5, skip=-5.0,
+                            input_lengths=None, target_lengths=None):
+    """Align a batch of BLD targets to a batch of BLD probabilities.
+
+    The alignment is computed on the device and in the dtype of `probs`.
+    Returns a (b, l, d) tensor of aligned, normalized targets.
+
+    If `input_lengths` or `target_lengths` are given, frames and target
+    positions past the length of each sample are ignored; the aligned
+    targets for ignored frames are uniform.
+    """
+    probs = helpers.novar(probs)
+    targets = helpers.novar(targets).type_as(probs)
+    b, l, d = probs.size()
+    bt, lt, dt = targets.size()
+    assert b == bt, (b, bt)
+    assert d == dt, (d, dt)
+    probs = probs.clamp(min=lo)
+    probs = probs / probs.sum(2, keepdim=True).expand_as(probs)
+    match = torch.bmm(probs, targets.transpose(1, 2).contiguous())
+    lmatch = match.clamp(min=1e-30).log()
+    lr = forward_algorithm(lmatch, skip)
+    if input_lengths is None and target_lengths is None:
+        rlmatch = reverse(reverse(lmatch, 1), 2).contiguous()
+        rl = reverse(reverse(forward_algorithm(rlmatch, skip), 1), 2)
+        both = lr + rl
+    else:
+        input_lengths = as_lengths(input_lengths, l, probs)
+        target_lengths = as_lengths(target_lengths, lt, probs)
+        tindex = reverse_valid(input_lengths, l).unsqueeze(2).expand(b, l, lt)
+        jindex = reverse_valid(target_lengths, lt).unsqueeze(1).expand(b, l, lt)
+        flip = lambda x: x.gather(1, tindex).gather(2, jindex)
+        rl = flip(forward_algorithm(flip(lmatch).contiguous(), skip))
+        both = lr + rl
+        valid = (valid_mask(input_lengths, l).unsqueeze(2).expand(b, l, lt) *
+                 valid_mask(target_lengths, lt).unsqueeze(1).expand(b, l, lt))
+        both.masked_fill_(valid.eq(0), -float("inf"))
+    top = both.view(b, l * lt).max(1, keepdim=True)[0].view(b, 1, 1)
+    epath = (both - top.expand_as(both)).exp()
+    total = epath.sum(1, keepdim=True)
+    total.masked_fill_(total.eq(0.0), 1e-9)
+    epath.div_(total.expand_as(epath))
+    aligned = torch.bmm(epath, targets).clamp(min=lo)
+    total = aligned.sum(2, keepdim=True)
+    total.masked_fill_(total.eq(0.0), 1e-9)
+    return aligned.div_(total.expand_as(aligned))
+
+def _align_chunk(args):
+    probs, targets, input_lengths, target_lengths = args
+    result = ctc_align_targets_batch(torch.from_numpy(probs),
+                                     torch.from_numpy(targets),
+                                     input_lengths=input_lengths,
+                                     target_lengths=target_lengths)
+    return result.numpy()
+
+def _chunk(lengths, lo, hi):
+    return None if lengths is None else np.asarray(lengths)[lo:hi]
+
+def get_pool(processes):
+    """Return a shared process pool with the given number of processes."""
+    global _pool, _pool_size
+    if _pool is None or _pool_size != processes:
+        if _pool is not None:
+            _pool.terminate()
+        _pool = multiprocessing.Pool(processes)
+        _pool_size = processes
+    return _pool
+
+def ctc_align_targets_parallel(probs, targets, processes=None,
+                               input_lengths=None, target_lengths=None):
+    """Like ctc_align_targets_batch, but splits the batch across processes.
+
+    Small batches (fewer samples than processes) are aligned in-process.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    probs = helpers.novar(probs)
+    b = probs.size(0)
+    if processes < 2 or b < processes:
+        return ctc_align_targets_batch(probs, targets,
+                                       input_lengths=input_lengths,
+                                       target_lengths=target_lengths)
+    probs_ = helpers.asnd(probs)
+    targets_ = helpers.asnd(helpers.novar(targets)).astype(probs_.dtype)
+    bounds = np.linspace(0, b, processes + 1).astype(int)
+    chunks = [(probs_[lo:hi], targets_[lo:hi],
+               _chunk(input_lengths, lo, hi), _chunk(target_lengths, lo, hi))
+              for lo, hi in zip(bounds[:-1], bounds[1:])]
+    results = get_pool(processes).map(_align_chunk, chunks)
+    return helpers.typeas(torch.from_numpy(np.concatenate(results)), probs)
+
+def ctc_align(probs, targets, engine="native", processes=None,
+              input_lengths=None, target_lengths=None):
+    """Align BLD targets to BLD probabilities with the given engine.
+
+    Engines are "native" (this module), "parallel" (this module, using
+    a process pool), and "cctc" (the external cctc package, which does
+    not support lengths).
+    """
+    if engine == "native":
+        return ctc_align_targets_batch(probs, targets,
+                                       input_lengths=input_lengths,
+                                       target_lengths=target_lengths)
+    elif engine == "parallel":
+        return ctc_align_targets_parallel(probs, targets, processes=processes,
+                                          input_lengths=input_lengths,
+                                          target_lengths=target_lengths)
+    elif engine == "cctc":
+        assert input_lengths is None and target_lengths is None, \
+            "the cctc engine does not support lengths"
+        import cctc
+        probs_ = helpers.novar(probs).cpu().contiguous()
+        targets_ = helpers.novar(targets).cpu().contiguous()
+        result = torch.rand(1)
+        cctc.ctc_align_targets_batch(result, probs_, targets_)
+        return helpers.typeas(result, helpers.novar(probs))
+    else:
+        raise ValueError("{}: unknown CTC engine".format(engine))
+
+def random_problem(b, l, d, nlabels):
+    """Generate random BLD probabilities and blank-separated targets."""
+    probs = torch.rand(b, l, d)
+    probs = probs / probs.sum(2, keepdim=True).expand_as(probs)
+    labels = torch.LongTensor(b, nlabels).random_(1, d)
+    targets = torch.zeros(b, 2 * nlabels + 1, d)
+    targets[:, :, 0] = 1.0
+    for i in range(nlabels):
+        targets[:, 2 * i + 1, 0] = 0.0
+        targets[:, 2 * i + 1].scatter_(1, labels[:, i:i+1], 1.0)
+    return probs, targets, labels
+
+def benchmark(b=32, l=200, d=64, nlabels=40, repeat=5, processes=None):
+    """Time the alignment engines against torch's built-in CTC loss.
+
+    Returns a dict mapping engine names to seconds per batch.
+    """
+    probs, targets, labels = random_problem(b, l, d, nlabels)
+    engines = [("native", lambda: ctc_align(probs, targets)),
+               ("parallel", lambda: ctc_align(probs, targets, "parallel",
+                                              processes=processes))]
+    F = torch.nn.functional
+    if hasattr(F, "ctc_loss"):
+        logits = probs.log().transpose(0, 1).contiguous().requires_grad_()
+        input_lengths = torch.LongTensor([l] * b)
+        target_lengths = torch.LongTensor([nlabels] * b)
+        def builtin():
+            loss = F.ctc_loss(F.log_softmax(logits, 2), labels,
+                              input_lengths, target_lengths)
+            loss.backward()
+        engines.append(("torch.ctc_loss", builtin))
+    results = {}
+    for name, f in engines:
+        f()
+        start = time.time()
+        for _ in range(repeat):
+            f()
+        results[name] = (time.time() - start) / repeat
+    return results
+
+if __name__ == "__main__":
+    for name, t in sorted(benchmark().items()):
+        print("{:20s} {:10.4f} s/batch".format(name, t))
@@ -0,0 +1,83 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Export of trained models for inference.
+
+`export_model` builds and freezes the Flex layers of a model, replaces
+`Fun` modules that wrap named functions by scriptable `NamedFun`
+modules, optimizes layouts, and then traces (or scripts) the model
+into a standalone TorchScript file. It can also write an ONNX file.
+Next to the TorchScript file, a small JSON file records the input
+shape and the axis order the caller's arrays need, for use by
+`runner.Runner` (see the `run-model` script).
+"""
+
+import json
+import torch
+from torch import nn
+import helpers as dlh
+import layers
+import layout
+import flex
+
+def named_fun_replacer(module):
+    if isinstance(module, layers.Fun) and isinstance(module.f, layers.NamedFun):
+        return module.f
+    return None
+
+def prepare(model, input_shape, optimize=True):
+    """Make model ready for export; it is modified in place and returned."""
+    flex.flex_build(model, input_shape)
+    flex.flex_freeze(model)
+    flex.replace_modules(model, named_fun_replacer)
+    if optimize:
+        layout.optimize_layout(model)
+    model.eval()
+    return model
+
+def example_input(model, input_shape):
+    parameters = list(model.parameters())
+    x = torch.zeros(*input_shape)
+    if len(parameters) > 0:
+        x = x.type_as(parameters[0].data)
+    return x
+
+def to_torchscript(model, input_shape, method="trace"):
+    """Trace or script a prepared model."""
+    if not hasattr(torch, "jit") or not hasattr(torch.jit, "trace"):
+        raise ValueError("export requires a version of torch with torch.jit")
+    if method == "script":
+        return torch.jit.script(model)
+    elif method == "trace":
+        with dlh.no_grad():
+            return torch.jit.trace(model, example_input(model, input_shape))
+    else:
+        raise ValueError("{}: unknown export method".format(method))
+
+def export_onnx(model, input_shape, path):
+    """Write a prepared model as ONNX, with a variable batch size."""
+    import torch.onnx
+    with dlh.no_grad():
+        torch.onnx.export(model, example_input(model, input_shape), path,
+                          input_names=["input"], output_names=["output"],
+                          dynamic_axes=dict(input={0: "batch"}, output={0: "batch"}))
+
+def export_model(model, input_shape, path, method="trace", onnx_path=None,
+                 input_transpose=None, output_transpose=None, optimize=True):
+    """Export model as TorchScript to path (and as ONNX to onnx_path).
+
+    input_shape is in the order the model expects. input_transpose and
+    output_transpose are the axis orders from the caller's arrays to the
+    model's (e.g., (0, 3, 1, 2) for BHWD images) and back; they are
+    recorded for the runner. Returns the TorchScript module.
+    """
+    prepare(model, input_shape, optimize=optimize)
+    module = to_torchscript(model, input_shape, method=method)
+    module.save(path)
+    meta = dict(input_shape=list(input_shape), method=method,
+                input_transpose=input_transpose, output_transpose=output_transpose)
+    with open(path + ".json", "w") as stream:
+        json.dump(meta, stream, indent=2)
+    if onnx_path is not None:
+        export_onnx(model, input_shape, onnx_path)
+    return module
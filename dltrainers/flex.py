@@ -1,6 +1,7 @@
 # Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
 # See the LICENSE file for licensing terms (BSD-style).
 
+import os
 import numpy as np
 import torch
 from torch import nn
@@ -17,24 +18,41 @@ import helpers
 import layers
 
 class Flex(nn.Module):
-    def __init__(self, creator):
+    def __init__(self, creator, spec=None):
         super(Flex, self).__init__()
         self.creator = creator
+        self.spec = spec
         self.layer = None
     def forward(self, *args):
         if self.layer is None:
             self.layer = self.creator(*args)
+            if args[0].is_cuda:
+                self.layer.cuda(args[0].get_device())
         return self.layer.forward(*args)
     def __repr__(self):
+        if self.layer is None and self.spec is not None:
+            return "Flex:"+self.spec
         return "Flex:"+repr(self.layer)
+    def cache_spec(self):
+        if self.layer is None:
+            return "Flex:"+(self.spec or getattr(self.creator, "__name__", "?"))
+        return "Flex:"+module_spec(self.layer)
     def __str__(self):
+        if self.layer is None and self.spec is not None:
+            return "Flex:"+self.spec
         return "Flex:"+str(self.layer)
 
+def flex_spec(name, args, kw):
+    """A string describing a Flex factory call, used as part of cache keys."""
+    args = [repr(x) for x in args]
+    args += ["{}={!r}".format(k, v) for k, v in sorted(kw.items())]
+    return "{}({})".format(name, ", ".join(args))
+
 def Linear(*args, **kw):
     def creator(x):
         assert x.ndimension()==2
         return nn.Linear(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("Linear", args, kw))
 
 
 def Conv1d(*args, **kw):
@@ -42,67 +60,67 @@ def Conv1d(*args, **kw):
         assert x.ndimension()==3
         d = x.size(1)
         return nn.Conv1d(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("Conv1d", args, kw))
 
 
 def Conv2d(*args, **kw):
     def creator(x):
         assert x.ndimension()==4
         return nn.Conv2d(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("Conv2d", args, kw))
 
 
 def Conv3d(*args, **kw):
     def creator(x):
         assert x.ndimension()==5
         return nn.Conv3d(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("Conv3d", args, kw))
 
 
 def Lstm1(*args, **kw):
     def creator(x):
         assert x.ndimension()==3
         return layers.LSTM1(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("Lstm1", args, kw))
 
 
 def LSTM1to0(*args, **kw):
     def creator(x):
         assert x.ndimension()==3
-        return layers.Lstm1to0(x.size(1), *args, **kw)
-    return Flex(creator)
+        return layers.LSTM1to0(x.size(1), *args, **kw)
+    return Flex(creator, flex_spec("LSTM1to0", args, kw))
 
 
 def Lstm2(*args, **kw):
     def creator(x):
         assert x.ndimension()==4
         return layers.LSTM2(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("Lstm2", args, kw))
 
 
 def Lstm2to1(*args, **kw):
     def creator(x):
         assert x.ndimension()==4
         return layers.LSTM2to1(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("Lstm2to1", args, kw))
 
 def BatchNorm1d(*args, **kw):
     def creator(x):
         assert x.ndimension()==3
         return nn.BatchNorm1d(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("BatchNorm1d", args, kw))
 
 def BatchNorm2d(*args, **kw):
     def creator(x):
         assert x.ndimension()==4
         return nn.BatchNorm2d(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("BatchNorm2d", args, kw))
 
 def BatchNorm3d(*args, **kw):
     def creator(x):
         assert x.ndimension()==5
         return nn.BatchNorm3d(x.size(1), *args, **kw)
-    return Flex(creator)
+    return Flex(creator, flex_spec("BatchNorm3d", args, kw))
 
 def replace_modules(model, f):
     for key in model._modules.keys():
@@ -127,3 +145,92 @@ def delete_modules(model, f):
         if f(model._modules[key]):
             del model._modules[key]
 
+
+def flex_unbuilt(model):
+    """Return the Flex modules in model whose layers are not created yet."""
+    return [m for m in model.modules() if isinstance(m, Flex) and m.layer is None]
+
+def flex_build(model, input_shape, freeze=False):
+    """Create all Flex layers in model ahead of time.
+
+    This runs a single volatile forward pass in eval mode on a zero
+    batch of size one with the given input shape (the batch dimension
+    of input_shape is ignored), so that every Flex creator sees the
+    sizes it needs. The batch is put on the device of the existing
+    parameters of the model (the CPU if there are none), so the new
+    layers are created where the model already is. With freeze=True,
+    the Flex wrappers are replaced by their layers afterwards.
+    """
+    if len(flex_unbuilt(model)) > 0:
+        shape = (1,) + tuple(input_shape)[1:]
+        training = model.training
+        batch = torch.zeros(*shape)
+        params = list(model.parameters())
+        if len(params) > 0 and params[0].is_cuda:
+            batch = batch.cuda(params[0].get_device())
+        model.eval()
+        model(Variable(batch, volatile=True))
+        model.train(training)
+        remaining = flex_unbuilt(model)
+        assert len(remaining) == 0, "Flex layers not reached: {}".format(remaining)
+    if freeze:
+        flex_freeze(model)
+    return model
+
+def module_spec(module):
+    """Describe a module like repr, but the same in every process.
+
+    Modules can define `cache_spec()` (Flex and layers.Fun do);
+    containers are described by their class and their children, and
+    other modules by their repr.
+    """
+    if hasattr(module, "cache_spec"):
+        return module.cache_spec()
+    children = list(module._modules.items())
+    if len(children) == 0:
+        return repr(module)
+    parts = ["({}): {}".format(key, module_spec(child)) for key, child in children]
+    return "{}({})".format(module.__class__.__name__, ", ".join(parts))
+
+def flex_cache_key(model, input_shape):
+    """A key for the frozen architecture of an unbuilt model."""
+    import hashlib
+    text = "{}\n{}".format(module_spec(model), tuple(input_shape)[1:])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def reset_parameters(model):
+    """Reinitialize the weights of every module of model that supports it."""
+    for module in model.modules():
+        if hasattr(module, "reset_parameters"):
+            module.reset_parameters()
+    return model
+
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "dltrainers", "flex")
+
+def flex_cached(model, input_shape, cache_dir=None):
+    """Return a frozen version of model, built once and cached on disk.
+
+    The model can also be given as a function returning the model.
+    The cache is keyed by the spec of the unbuilt model and the input
+    shape. Only the architecture is reused: models loaded from the
+    cache are loaded on the CPU and get fresh weights (see
+    `reset_parameters`), like newly built ones.
+    """
+    if not isinstance(model, nn.Module):
+        model = model()
+    cache_dir = cache_dir or default_cache_dir
+    fname = os.path.join(cache_dir, flex_cache_key(model, input_shape) + ".pt")
+    if os.path.exists(fname):
+        loaded = torch.load(fname, map_location=lambda storage, location: storage)
+        return reset_parameters(loaded)
+    flex_build(model, input_shape, freeze=True)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    tmpname = "{}.{}.tmp".format(fname, os.getpid())
+    torch.save(model, tmpname)
+    os.rename(tmpname, fname)
+    return model
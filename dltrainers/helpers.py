@@ -4,12 +4,16 @@
 """A set of helper functions for dealing uniformly with tensors and
 ndarrays."""
 
+import bisect
+import contextlib
+import math
 import numpy as np
 import torch
 from torch import autograd, nn, optim
 from torch.autograd import Variable
 import torch.nn.functional as F
 from scipy import ndimage
+from collections import OrderedDict, defaultdict
 
 torch_tensor_types = tuple([
     torch.Tensor,
@@ -27,8 +31,12 @@ def asnd(x):
         x = x.cpu()
     return x.numpy()
 
-def as_nda(x, transpose_on_convert=None):
-    """Turns any tensor into an ndarray."""
+def as_nda(x, transpose_on_convert=None, counter=None):
+    """Turns any tensor into an ndarray.
+
+    Tensors are transposed (and made contiguous) on their device before
+    the transfer, so at most one copy is made on each side.
+    """
     if isinstance(x, np.ndarray):
         return x
     if isinstance(x, list):
@@ -36,28 +44,45 @@ def as_nda(x, transpose_on_convert=None):
     if isinstance(x, autograd.Variable):
         x = x.data
     if isinstance(x, torch_tensor_types):
-        x = x.cpu().numpy()
-        return np.ascontiguousarray(maybe_transpose(x, transpose_on_convert))
+        if transpose_on_convert is not None:
+            x = x.permute(*transpose_on_convert)
+        if not x.is_contiguous():
+            x = x.contiguous()
+            count_copy(counter, "device" if x.is_cuda else "host", x)
+        if x.is_cuda:
+            x = x.cpu()
+            count_copy(counter, "d2h", x)
+        return x.numpy()
     raise ValueError("{}: can't convert to np.array".format(type(x)))
 
 def astorch(x, single=True):
-    """Convert torch/numpy to torch."""
+    """Convert torch/numpy to torch.
+
+    Arrays that already have the target dtype are wrapped without
+    copying, so the tensor shares their memory.
+    """
     if isinstance(x, np.ndarray):
         if x.dtype == np.dtype("f"):
-            return torch.FloatTensor(x)
+            return from_numpy(np.ascontiguousarray(x))
         elif x.dtype == np.dtype("d"):
             if single:
                 return torch.FloatTensor(x)
             else:
-                return torch.DoubleTensor(x)
+                return from_numpy(np.ascontiguousarray(x))
         elif x.dtype == np.dtype("i"):
-            return torch.IntTensor(x)
+            return from_numpy(np.ascontiguousarray(x))
         else:
             error("unknown np.dtype")
     return x
 
 def as_torch(x, transpose_on_convert=None, single=True):
-    """Converts any kind of tensor/array into a torch tensor."""
+    """Converts any kind of tensor/array into a torch tensor.
+
+    Arrays that already have the target dtype (float32, int64, and
+    float64 with single=False) are wrapped without copying, unless
+    the transpose makes them non-contiguous; the tensor then shares
+    their memory.
+    """
     if isinstance(x, Variable):
         return x.data
     if isinstance(x, torch_tensor_types):
@@ -67,18 +92,84 @@ def as_torch(x, transpose_on_convert=None, single=True):
     if isinstance(x, np.ndarray):
         x = maybe_transpose(x, transpose_on_convert)
         if x.dtype == np.dtype("f"):
-            return torch.FloatTensor(x)
+            return from_numpy(np.ascontiguousarray(x))
         elif x.dtype == np.dtype("d"):
             if single:
                 return torch.FloatTensor(x)
             else:
-                return torch.DoubleTensor(x)
-        elif x.dtype in [np.dtype("i"), np.dtype("int64")]:
+                return from_numpy(np.ascontiguousarray(x))
+        elif x.dtype == np.dtype("int64"):
+            return from_numpy(np.ascontiguousarray(x))
+        elif x.dtype == np.dtype("i"):
             return torch.LongTensor(x)
         else:
             raise ValueError("{} {}: unknown dtype".format(x, x.dtype))
     raise ValueError("{} {}: unknown type".format(x, type(x)))
 
+class CopyCounter(object):
+    """Counts the copies made by conversions, and their bytes, by kind.
+
+    The kinds are "host" (host memory to host memory, including casts),
+    "h2d" and "d2h" (transfers), and "device" (on the GPU).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def add(self, kind, nbytes):
+        self.counts[kind] += 1
+        self.bytes[kind] += nbytes
+
+    def total_bytes(self):
+        return sum(self.bytes.values())
+
+    def summary(self):
+        return dict((kind, dict(count=self.counts[kind], bytes=self.bytes[kind]))
+                    for kind in self.counts)
+
+def count_copy(counter, kind, x):
+    """Record a copy of tensor or array x in counter (which may be None)."""
+    if counter is not None:
+        if isinstance(x, np.ndarray):
+            counter.add(kind, x.nbytes)
+        else:
+            counter.add(kind, x.numel() * x.element_size())
+
+numpy_wrappable = set(np.dtype(t) for t in ["f", "d", "float16", "int64", "int32",
+                                           "int16", "uint8"])
+
+def from_numpy(x, counter=None):
+    """Wrap an array as a torch tensor, sharing its memory where possible.
+
+    The dtype is kept. Arrays that torch cannot wrap (negative strides,
+    non-native byte order, unsupported dtypes) are copied first.
+    """
+    x = np.asarray(x)
+    if x.dtype not in numpy_wrappable:
+        x = x.astype("f")
+        count_copy(counter, "host", x)
+    elif not x.dtype.isnative or any(stride < 0 for stride in x.strides):
+        x = np.ascontiguousarray(x, x.dtype.newbyteorder("="))
+        count_copy(counter, "host", x)
+    return torch.from_numpy(x)
+
+def tensor_type(name):
+    """An empty CPU tensor of the given type name (e.g. "torch.FloatTensor")."""
+    return getattr(torch, name.split(".")[-1])()
+
+def conversion_type(x, dtype=None, single=True):
+    """The CPU type name for converting x: dtype, or that of x (double -> float)."""
+    if dtype is not None:
+        return dtype
+    name = x.type().replace(".cuda", "")
+    if single and name == "torch.DoubleTensor":
+        return "torch.FloatTensor"
+    return name
+
 def is_tensor(x):
     if isinstance(x, Variable):
         x = x.data
@@ -115,6 +206,14 @@ def novar(x):
         return x.data
     return x
 
+def scalar(x):
+    """Reads a one-element tensor or variable back as a float.
+
+    Losses are one-element tensors in older versions of torch and 0-dim
+    tensors in newer ones; this works for both.
+    """
+    return float(novar(x).view(-1)[0])
+
 def maybe_transpose(x, axes):
     if axes is None: return x
     return x.transpose(axes)
@@ -133,6 +232,49 @@ def typeas(x, y):
             x = torch.DoubleTensor(x)
     return x.type_as(y)
 
+validation = dict(level="always", override=None, step=0)
+
+def set_validation(level):
+    """Set the global level for runtime checks.
+
+    The level is "off", "always", or an integer N, in which case the
+    checks only run on every N-th step (see `begin_validation_step`).
+    """
+    assert level in ("off", "always") or (isinstance(level, int) and level > 0), level
+    validation["level"] = level
+
+def begin_validation_step(level=None):
+    """Start a new step for sampled checks; level overrides the global level."""
+    validation["step"] += 1
+    validation["override"] = level
+
+def should_validate():
+    """Whether runtime checks should run in the current step."""
+    level = validation["override"]
+    if level is None:
+        level = validation["level"]
+    if level == "always":
+        return True
+    if level == "off":
+        return False
+    return validation["step"] % level == 0
+
+def minmax(x):
+    """Return the minimum and maximum of a tensor with a single readback.
+
+    With torch.aminmax, both come from one pass over x; older versions
+    of torch have no such reduction, and x is reduced twice.
+    """
+    x = novar(x)
+    if hasattr(torch, "aminmax"):
+        lo, hi = torch.aminmax(x)
+        both = torch.stack([lo, hi])
+    else:
+        flat = x.contiguous().view(-1)
+        both = torch.cat([flat.min(0)[0].view(1), flat.max(0)[0].view(1)])
+    both = both.cpu()
+    return float(both[0]), float(both[1])
+
 def sequence_is_normalized(x, d, eps=1e-3):
     """Check whether a batch of sequences BDL is normalized in d."""
     if isinstance(x, Variable):
@@ -177,6 +319,70 @@ def reorder(batch, inp, out):
     elif isinstance(batch, np.ndarray):
         return batch.transpose(*result)
 
+@contextlib.contextmanager
+def null_context():
+    yield
+
+def no_grad():
+    """A context that turns off gradient tracking, where torch supports it.
+
+    Older versions of torch use volatile Variables instead.
+    """
+    if hasattr(torch, "no_grad"):
+        return torch.no_grad()
+    return null_context()
+
+class LossScaler(object):
+    """Loss scaling for float16 training.
+
+    The loss is multiplied by `scale` before the backward pass, and the
+    gradients are divided by it before the optimizer step. If dynamic,
+    the scale is multiplied by `backoff` whenever the gradients are not
+    finite (and the step is skipped), and by `growth` after `interval`
+    good steps.
+    """
+
+    def __init__(self, scale=2.0**16, dynamic=True, growth=2.0, backoff=0.5, interval=2000):
+        self.scale = scale
+        self.dynamic = dynamic
+        self.growth = growth
+        self.backoff = backoff
+        self.interval = interval
+        self.good = 0
+        self.skipped = 0
+
+    def unscale(self, parameters):
+        """Divide the gradients by the scale; returns whether all are finite.
+
+        The check reads back a single number, the sum of the absolute
+        gradients, which is inf or NaN if any gradient is. Gradients
+        that are not finite are left alone.
+        """
+        grads = [p.grad.data for p in parameters if p.grad is not None]
+        if len(grads) == 0:
+            return True
+        sums = [grad.contiguous().view(-1).abs().sum(0).view(1) for grad in grads]
+        total = scalar(torch.cat(sums).sum(0))
+        if math.isinf(total) or math.isnan(total):
+            return False
+        for grad in grads:
+            grad.mul_(1.0 / self.scale)
+        return True
+
+    def update(self, finite):
+        if not finite:
+            self.skipped += 1
+        if not self.dynamic:
+            return
+        if not finite:
+            self.scale *= self.backoff
+            self.good = 0
+        else:
+            self.good += 1
+            if self.good >= self.interval:
+                self.scale *= self.growth
+                self.good = 0
+
 def assign(dest, src, transpose_on_convert=None):
     """Resizes the destination and copies the source."""
     src = as_torch(src, transpose_on_convert)
@@ -187,6 +393,129 @@ def assign(dest, src, transpose_on_convert=None):
     else:
         raise ValueError("{}: unknown type".format(type(dest)))
 
+def copy_async(dest, src):
+    """Copies src into dest without blocking the host if possible."""
+    try:
+        return dest.copy_(src, non_blocking=True)
+    except TypeError:
+        return dest.copy_(src, **{"async": True})
+
+class BufferPool(object):
+    """A pool of preallocated tensors keyed by shape, dtype and device.
+
+    Each buffer is identified by a name ("input", "target", ...). For
+    CUDA pools, host data is first copied into a pinned staging buffer
+    and then transferred to the device without blocking; a CUDA event
+    guards reuse of the staging buffer. At most `maxsize` shapes are
+    kept per name; older ones are evicted in LRU order.
+    """
+
+    def __init__(self, use_cuda=False, pin_memory=True, maxsize=8, counter=None):
+        self.use_cuda = use_cuda
+        self.pin_memory = pin_memory and use_cuda
+        self.maxsize = maxsize
+        self.buffers = OrderedDict()
+        self.staging = OrderedDict()
+        self.nalloc = 0
+        self.counter = counter
+
+    def device(self):
+        if self.use_cuda:
+            return torch.cuda.current_device()
+        return "cpu"
+
+    def _lookup(self, table, key, make):
+        if key in table:
+            value = table.pop(key)
+        else:
+            value = make()
+            self.nalloc += 1
+            names = [k for k in table.keys() if k[0] == key[0]]
+            if len(names) >= self.maxsize:
+                del table[names[0]]
+        table[key] = value
+        return value
+
+    def get(self, name, shape, like):
+        """Returns the device buffer for name with the shape and dtype of like."""
+        shape = tuple(shape)
+        key = (name, shape, like.type().replace(".cuda", ""), self.device())
+        def make():
+            buffer = like.new(*shape)
+            return buffer.cuda() if self.use_cuda else buffer
+        return self._lookup(self.buffers, key, make)
+
+    def _get_staging(self, name, shape, like):
+        key = (name, tuple(shape), like.type())
+        def make():
+            return [like.new(*shape).pin_memory(), None]
+        return self._lookup(self.staging, key, make)
+
+    def assign(self, name, src, transpose_on_convert=None, dtype=None):
+        """Copies src into the pooled buffer for name and returns it.
+
+        Arrays are wrapped without copying (see `from_numpy`); their
+        dtype is kept, except that doubles become floats, unless a
+        tensor type name is given as dtype. As with `as_torch`, the
+        transpose only applies to arrays; tensors are taken to be in
+        model order already. On the host, it is folded into the single
+        copy into the buffer. For CUDA pools, the data is transferred in
+        its original layout, in the narrower of its own type and dtype,
+        and then transposed and converted on the device; pinned sources
+        are transferred directly, without staging.
+        """
+        src = novar(src)
+        if is_tensor(src):
+            transpose_on_convert = None
+        else:
+            if isinstance(src, list):
+                src = np.array(src)
+            src = from_numpy(src, self.counter)
+        if src.is_cuda and not self.use_cuda:
+            src = src.cpu()
+            count_copy(self.counter, "d2h", src)
+        like = tensor_type(conversion_type(src, dtype))
+        shape = list(src.size())
+        if transpose_on_convert is not None:
+            shape = [shape[i] for i in transpose_on_convert]
+        if not self.use_cuda or src.is_cuda:
+            dest = self.get(name, shape, like)
+            permuted = src if transpose_on_convert is None else src.permute(*transpose_on_convert)
+            dest.copy_(permuted)
+            count_copy(self.counter, "device" if src.is_cuda else "host", dest)
+            return dest
+        wire = tensor_type(conversion_type(src, single=False))
+        if wire.element_size() > like.element_size():
+            wire = like
+        converted = transpose_on_convert is not None or wire.type() != like.type()
+        raw = self.get(name + "_raw" if converted else name, src.size(), wire)
+        if src.is_pinned() and src.is_contiguous() and src.type() == wire.type():
+            # already pinned (e.g., by a prefetch.Prefetcher)
+            copy_async(raw, src)
+        elif self.pin_memory:
+            slot = self._get_staging(name, src.size(), wire)
+            staging, event = slot
+            if event is not None:
+                event.synchronize()
+            staging.copy_(src)
+            count_copy(self.counter, "host", staging)
+            copy_async(raw, staging)
+            slot[1] = torch.cuda.Event()
+            slot[1].record()
+        else:
+            raw.copy_(src)
+        count_copy(self.counter, "h2d", raw)
+        if not converted:
+            return raw
+        dest = self.get(name, shape, like)
+        dest.copy_(raw if transpose_on_convert is None else raw.permute(*transpose_on_convert))
+        count_copy(self.counter, "device", dest)
+        return dest
+
+    def clear(self):
+        self.buffers.clear()
+        self.staging.clear()
+
 def one_sequence_softmax(x):
     """Compute softmax over a sequence; shape is (l, d)"""
     y = asnd(x)
@@ -198,41 +527,81 @@ def one_sequence_softmax(x):
     y = y / np.sum(y, axis=1)[:, np.newaxis]
     return typeas(y, x)
 
-def sequence_softmax(x):
-    """Compute sotmax over a batch of sequences; shape is (b, l, d)."""
-    y = asnd(x)
-    assert y.ndim==3, "%s: input should be (batch, length, depth)" % y.shape
-    for i in range(len(y)):
-        y[i] = one_sequence_softmax(y[i])
-    return typeas(y, x)
+def batched_softmax(x, dim, out=None, log=False):
+    """Compute softmax (or log softmax) over dimension dim of a batch.
+
+    This works on tensors and Variables and stays on the device and
+    dtype of x. For tensors, the result can be written into `out`,
+    which may be x itself.
+    """
+    shift = x.max(dim, keepdim=True)[0].expand_as(x)
+    if out is None:
+        y = x - shift
+    else:
+        assert not isinstance(x, Variable), "out= requires a tensor"
+        y = out.resize_as_(x)
+        if y is not x:
+            y.copy_(x)
+        y.sub_(shift)
+    if log:
+        lse = y.exp().sum(dim, keepdim=True).log().expand_as(y)
+        return y - lse if out is None else y.sub_(lse)
+    if out is None:
+        y = y.exp()
+        return y / y.sum(dim, keepdim=True).expand_as(y)
+    y.exp_()
+    return y.div_(y.sum(dim, keepdim=True).expand_as(y))
+
+def sequence_softmax(x, out=None, log=False):
+    """Compute sotmax over a batch of sequences; shape is (b, l, d).
+
+    Like one_sequence_softmax, this normalizes exp(max - x) with the
+    exponent clipped to 80, but the whole batch is processed at once
+    on the device and in the dtype of x.
+    """
+    if isinstance(x, np.ndarray):
+        return asnd(sequence_softmax(torch.from_numpy(x), out=out, log=log))
+    assert rank(x)==3, "%s: input should be (batch, length, depth)" % (shp(x),)
+    shift = x.max(2, keepdim=True)[0].expand_as(x)
+    if out is None:
+        y = (shift - x).clamp(-80, 80)
+    else:
+        y = out.resize_as_(x)
+        if y is not x:
+            y.copy_(x)
+        y.neg_().add_(shift).clamp_(-80, 80)
+    if isinstance(y, Variable):
+        return batched_softmax(y, 2, log=log)
+    return batched_softmax(y, 2, out=y, log=log)
+
+def ctc_align(prob, target, engine="native"):
+    """Perform CTC alignment on torch sequence batches (BLD).
 
-def ctc_align(prob, target):
-    """Perform CTC alignment on torch sequence batches (using ocrolstm)"""
-    import cctc
-    prob_ = prob.cpu()
-    target = target.cpu()
+    See `ctc.ctc_align` for the available engines.
+    """
+    import ctc
     b, l, d = prob.size()
     bt, lt, dt = target.size()
     assert bt==b, (bt, b)
     assert dt==d, (dt, d)
-    assert sequence_is_normalized(prob, 2), prob
-    assert sequence_is_normalized(target, 2), target
-    result = torch.rand(1)
-    cctc.ctc_align_targets_batch(result, prob_, target)
-    return typeas(result, prob)
+    if should_validate():
+        assert sequence_is_normalized(prob, 2), prob
+        assert sequence_is_normalized(target, 2), target
+    return ctc.ctc_align(prob, target, engine=engine)
 
-def ctc_loss(logits, target):
+def ctc_loss(logits, target, engine="native"):
     """A CTC loss function for BLD sequence training."""
     assert logits.is_contiguous()
     assert target.is_contiguous()
     probs = sequence_softmax(logits)
-    aligned = ctc_align(probs, target)
+    aligned = ctc_align(probs, target, engine=engine)
     assert aligned.size()==probs.size(), (aligned.size(), probs.size())
     deltas = aligned - probs
     logits.backward(deltas.contiguous())
     return deltas, aligned
 
 class LearningRateSchedule(object):
+    """A piecewise constant schedule, "0,lr0:n1,lr1:...", or a single rate."""
     def __init__(self, schedule):
         if ":" in schedule:
             self.learning_rates = [[float(y) for y in x.split(",")] for x in schedule.split(":")]
@@ -240,10 +609,50 @@ class LearningRateSchedule(object):
         else:
             lr0 = float(schedule)
             self.learning_rates = [[0, lr0]]
+        self.starts = [n for n, _ in self.learning_rates]
+        assert self.starts == sorted(self.starts), "breakpoints must be increasing"
+    def __call__(self, count):
+        i = bisect.bisect_right(self.starts, count) - 1
+        return self.learning_rates[max(i, 0)][1]
+
+class ExponentialSchedule(object):
+    """lr * gamma ** (count / step), but at least min_lr."""
+    def __init__(self, lr, gamma, step=1, min_lr=0.0):
+        self.lr = lr
+        self.gamma = gamma
+        self.step = step
+        self.min_lr = min_lr
     def __call__(self, count):
-        _, lr = self.learning_rates[0]
-        for n, l in self.learning_rates:
-            if count < n: break
-            lr = l
-        return lr
+        return max(self.min_lr, self.lr * self.gamma ** (count * 1.0 / self.step))
+
+class CosineSchedule(object):
+    """Cosine annealing from lr to min_lr over total, then min_lr."""
+    def __init__(self, lr, total, min_lr=0.0):
+        self.lr = lr
+        self.total = total
+        self.min_lr = min_lr
+    def __call__(self, count):
+        t = min(max(count, 0), self.total) * 1.0 / self.total
+        return self.min_lr + 0.5 * (self.lr - self.min_lr) * (1.0 + math.cos(math.pi * t))
+
+class WarmupSchedule(object):
+    """Linear warmup from start * schedule(warmup) for the first warmup counts."""
+    def __init__(self, schedule, warmup, start=0.0):
+        self.schedule = make_schedule(schedule)
+        self.warmup = warmup
+        self.start = start
+    def __call__(self, count):
+        if count >= self.warmup:
+            return self.schedule(count)
+        target = self.schedule(self.warmup)
+        frac = max(count, 0) * 1.0 / self.warmup
+        return target * (self.start + (1.0 - self.start) * frac)
+
+def make_schedule(schedule):
+    """Turn a number, schedule string, or function of the count into a schedule."""
+    if callable(schedule):
+        return schedule
+    if isinstance(schedule, str):
+        return LearningRateSchedule(schedule)
+    return LearningRateSchedule(str(float(schedule)))
 
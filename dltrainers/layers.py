@@ -13,6 +13,9 @@ from torch import nn
 from torch import autograd
 from torch.autograd import Variable
 from torch.legacy import nn as legnn
+import torch.nn.functional as F
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import helpers
 
 BD = "BD"
@@ -29,14 +32,24 @@ def deprecated(f):
         raise Exception("deprecated")
     return g
 
+copy_stats = dict(count=0, bytes=0)
+
+def contiguous(x):
+    """Like x.contiguous(), but counts the copies made in copy_stats."""
+    if x.is_contiguous():
+        return x
+    copy_stats["count"] += 1
+    copy_stats["bytes"] += x.numel() * data(x).element_size()
+    return x.contiguous()
+
 def lbd2bdl(x):
     assert len(x.size()) == 3
-    return x.permute(1, 2, 0).contiguous()
+    return contiguous(x.permute(1, 2, 0))
 
 
 def bdl2lbd(x):
     assert len(x.size()) == 3
-    return x.permute(2, 0, 1).contiguous()
+    return contiguous(x.permute(2, 0, 1))
 
 def data(x):
     if isinstance(x, Variable):
@@ -59,24 +72,86 @@ def typeas(x, y):
             x = torch.DoubleTensor(x)
     return x.type_as(y)
 
+def tracing():
+    """Whether a torch.jit trace is being recorded."""
+    is_tracing = getattr(getattr(torch, "jit", None), "is_tracing", None)
+    return bool(is_tracing is not None and is_tracing())
+
+fun_names = ("identity", "relu", "sigmoid", "tanh", "exp", "log", "abs")
+
+class NamedFun(nn.Module):
+    """Applies the elementwise function with the given name (see fun_names).
+
+    Unlike Fun with an expression, this can be scripted and pickled.
+    """
+    def __init__(self, name):
+        nn.Module.__init__(self)
+        assert name in fun_names, name
+        self.name = name
+    def forward(self, x):
+        if self.name == "relu":
+            return F.relu(x)
+        if self.name == "sigmoid":
+            return torch.sigmoid(x)
+        if self.name == "tanh":
+            return torch.tanh(x)
+        if self.name == "exp":
+            return torch.exp(x)
+        if self.name == "log":
+            return torch.log(x)
+        if self.name == "abs":
+            return torch.abs(x)
+        return x
+    def __repr__(self):
+        return "NamedFun {}".format(self.name)
+
 class Fun(nn.Module):
+    """Applies a function.
+
+    f is a name from fun_names (see NamedFun), a callable, or, for
+    compatibility, a Python expression string that is evaluated.
+    """
     def __init__(self, f, info=None):
         nn.Module.__init__(self)
-        assert isinstance(f, str)
-        self.f = eval(f)
-        self.f_str = f
+        self.f_str = None
+        if isinstance(f, str) and f in fun_names:
+            f = NamedFun(f)
+        elif isinstance(f, str):
+            self.f_str = f
+            f = eval(f)
+        assert callable(f), f
+        self.f = f
         self.info = info
     def __getnewargs__(self):
-        return (self.f_str, self.info)
+        return (self.f_str or self.f, self.info)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.f_str is not None:
+            state.pop("f", None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "f" not in state and "f" not in self._modules:
+            self.f = eval(self.f_str)
     def forward(self, x):
         return self.f(x)
+    def cache_spec(self):
+        """A description without object addresses (see flex.module_spec)."""
+        if self.f_str is not None:
+            f = self.f_str
+        elif isinstance(self.f, NamedFun):
+            f = self.f.name
+        else:
+            f = "{}.{}".format(getattr(self.f, "__module__", None),
+                               getattr(self.f, "__name__", type(self.f).__name__))
+        return "Fun {} {}".format(self.info, f)
     def __repr__(self):
         return "Fun {} {}".format(self.info, self.f)
 
 class PixelsToBatch(nn.Module):
     def forward(self, x):
         b, d, h, w = x.size()
-        return x.permute(0, 2, 3, 1).contiguous().view(b*h*w, d)
+        return contiguous(x.permute(0, 2, 3, 1)).view(b*h*w, d)
 
 class WeightedGrad(autograd.Function):
     def forward(self, input, weights):
@@ -105,6 +180,8 @@ class CheckSizes(nn.Module):
         self.name = kw.get("name")
         self.limits = [(x, x) if isinstance(x, int) else x for x in args]
     def forward(self, x):
+        if not helpers.should_validate():
+            return x
         for (i, actual), (lo, hi) in zip(enumerate(tuple(x.size())), self.limits):
             if actual < lo:
                 raise Exception("{} ({}): index {} too low ({} not >= {})"
@@ -151,14 +228,17 @@ class Check(nn.Module):
         self.expected = tuple(shape)
         self.valid = kw.get("valid", (-1e-5, 1+1e-5))
     def forward(self, x):
+        if not helpers.should_validate():
+            return x
         expected_shape = self.expected
         actual_shape = tuple(x.size())
         assert len(actual_shape)==len(expected_shape)
         for i in range(len(actual_shape)):
             assert expected_shape[i]<0 or expected_shape[i]==actual_shape[i], \
                    (expected_shape, actual_shape, i)
-        assert data(x).min() >= self.valid[0], (data(x).min(), self.valid)
-        assert data(x).max() <= self.valid[1], (data(x).max(), self.valid)
+        lo, hi = helpers.minmax(x)
+        assert lo >= self.valid[0], (lo, self.valid)
+        assert hi <= self.valid[1], (hi, self.valid)
         return x
 
 class Reorder(nn.Module):
@@ -167,8 +247,12 @@ class Reorder(nn.Module):
         self.new = new
         nn.Module.__init__(self)
         self.permutation = tuple([old.find(c) for c in new])
+        self.make_contiguous = True
     def forward(self, x):
-        return x.permute(*self.permutation).contiguous()
+        x = x.permute(*self.permutation)
+        if getattr(self, "make_contiguous", True):
+            x = contiguous(x)
+        return x
     def __repr__(self):
         return "Reorder {}->{}".format(self.old, self.new)
 
@@ -176,8 +260,12 @@ class Permute(nn.Module):
     def __init__(self, *args):
         nn.Module.__init__(self)
         self.permutation = args
+        self.make_contiguous = True
     def forward(self, x):
-        return x.permute(*self.permutation).contiguous()
+        x = x.permute(*self.permutation)
+        if getattr(self, "make_contiguous", True):
+            x = contiguous(x)
+        return x
     def __repr__(self):
         return "Permute({})".format(self.permutation)
 
@@ -268,7 +356,48 @@ class Textline2Img(nn.Module):
         return "Textline2Img"
 
 
-class Img2Seq(nn.Module):
+class SequenceLengths(object):
+    """Mixin for layers that honor the lengths of padded sequences.
+
+    Lengths are given as fractions of the padded length (see
+    `set_sequence_fractions`), so that they stay valid when earlier
+    layers pool or stride along the sequence axis.
+    """
+    seq_fractions = None
+
+    def sequence_lengths(self, l):
+        """Per-sample lengths for a padded length l, or None."""
+        if self.seq_fractions is None:
+            return None
+        lengths = np.ceil(np.asarray(self.seq_fractions, "d") * l - 1e-6).astype(int)
+        return np.clip(lengths, 1, l)
+
+    def sequence_mask(self, l, like):
+        """A (b, 1, l) mask Variable that is 1 on the valid frames, or None."""
+        lengths = self.sequence_lengths(l)
+        if lengths is None or np.all(lengths == l):
+            return None
+        mask = (np.arange(l)[np.newaxis, :] < lengths[:, np.newaxis]).astype("f")
+        mask = helpers.typeas(torch.from_numpy(mask[:, np.newaxis, :]), data(like))
+        return Variable(mask, requires_grad=False)
+
+def set_sequence_fractions(model, fractions):
+    """Set the valid fraction of each sample for length-aware layers.
+
+    fractions[i] is the length of sample i divided by the padded length
+    of the batch; None means all samples use the full length.
+    """
+    if fractions is not None:
+        fractions = np.asarray(fractions, "d")
+    for module in model.modules():
+        if isinstance(module, SequenceLengths):
+            module.seq_fractions = fractions
+
+class Img2Seq(SequenceLengths, nn.Module):
+    """Turn a BDWH image into a BDL sequence along W.
+
+    Frames past the length of each sample are set to zero.
+    """
     input_order = BDWH
     output_order = BDL
 
@@ -277,8 +406,12 @@ class Img2Seq(nn.Module):
 
     def forward(self, img):
         b, d, w, h = img.size()
-        perm = img.permute(0, 1, 3, 2).contiguous()
-        return perm.view(b, d * h, w)
+        perm = contiguous(img.permute(0, 1, 3, 2))
+        seq = perm.view(b, d * h, w)
+        mask = self.sequence_mask(w, seq)
+        if mask is not None:
+            seq = seq * mask.expand_as(seq)
+        return seq
 
     def __repr__(self):
         return "Img2Seq"
@@ -306,20 +439,69 @@ class ImgSumSeq(nn.Module):
 
     def forward(self, img):
         # BDWH -> BDW -> BWD
-        return img.sum(3)[0].squeeze(3).permute(0, 2, 1).contiguous()
+        return contiguous(img.sum(3)[0].squeeze(3).permute(0, 2, 1))
 
     def __repr__(self):
         return "ImgSumSeq"
 
 
-class LSTM1(nn.Module):
+class ZeroStates(object):
+    """Mixin for LSTM layers that caches their zero initial states.
+
+    The zero tensors are kept per (shape, dtype, device), at most
+    `max_zero_states` of them, and are not saved with the module.
+    """
+    max_zero_states = 4
+
+    def zero_states(self, ndir, bs, like, volatile=False):
+        """Returns zero (h0, c0) Variables of size (ndir, bs, noutput)."""
+        x = data(like)
+        shape = (ndir, bs, self.noutput)
+        key = (shape, x.type(), x.get_device() if x.is_cuda else -1)
+        cache = self.__dict__.setdefault("_zero_states", OrderedDict())
+        zeros = cache.pop(key, None)
+        if zeros is None:
+            zeros = x.new(*shape).zero_()
+            if len(cache) >= self.max_zero_states:
+                cache.popitem(last=False)
+        cache[key] = zeros
+        return Variable(zeros, volatile=volatile), Variable(zeros, volatile=volatile)
+
+    def lstm_states(self, states):
+        """The initial states for the LSTM; None while tracing, so that
+        traced models are not tied to the batch size of the trace."""
+        return None if tracing() else states
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_zero_states", None)
+        state.pop("_carry", None)
+        return state
+
+class LSTM1(ZeroStates, SequenceLengths, nn.Module):
     """A simple bidirectional LSTM.
 
     All the sequence processing layers use BDL order by default to
-    be consistent with 1D convolutions.
+    be consistent with 1D convolutions. The input and output orders
+    can be switched to LBD (e.g., by `layout.optimize_layout`) to avoid
+    conversions between stacked LSTMs.
+
+    In stateful mode (`set_stateful`), the final state of the forward
+    direction is carried over to the next call, so that long sequences
+    can be processed in chunks with constant memory; gradients do not
+    flow across chunks. The reverse direction starts from zero in each
+    chunk.
+
+    If sequence lengths are set (`set_sequence_fractions`), the padded
+    batch is run as a packed sequence, so that padding does not enter
+    the state of either direction; outputs past the length are zero.
     """
+    stateful = False
+
     input_order = BDL
     output_order = BDL
+    input_orders = (BDL, LBD)
+    output_orders = (BDL, LBD)
 
     def __init__(self, ninput=None, noutput=None, ndir=2):
         nn.Module.__init__(self)
@@ -331,15 +513,60 @@ class LSTM1(nn.Module):
         self.lstm = nn.LSTM(ninput, noutput, 1, bidirectional=self.ndir - 1)
 
     def forward(self, seq, volatile=False):
-        seq = bdl2lbd(seq)
+        if self.input_order == BDL:
+            seq = bdl2lbd(seq)
         l, bs, d = seq.size()
         assert d == self.ninput, seq.size()
-        h0 = Variable(helpers.typeas(torch.zeros(self.ndir, bs, self.noutput), seq),
-                      volatile=volatile)
-        c0 = Variable(helpers.typeas(torch.zeros(self.ndir, bs, self.noutput), seq),
-                      volatile=volatile)
-        post_lstm, _ = self.lstm(seq, (h0, c0))
-        return lbd2bdl(post_lstm)
+        h0, c0 = self.zero_states(self.ndir, bs, seq, volatile)
+        lengths = self.sequence_lengths(l)
+        if lengths is not None and not np.all(lengths == l):
+            assert not self.stateful, "stateful LSTM1 does not take lengths"
+            post_lstm = self.packed(seq, lengths, h0, c0)
+            return lbd2bdl(post_lstm) if self.output_order == BDL else post_lstm
+        carry = self.__dict__.get("_carry") if self.stateful else None
+        if carry is not None and carry[0].size(1) == bs:
+            h0, c0 = [self.carried(state, zero, volatile)
+                      for state, zero in zip(carry, (h0, c0))]
+        post_lstm, (hn, cn) = self.lstm(seq, self.lstm_states((h0, c0)))
+        if self.stateful:
+            self._carry = (data(hn), data(cn))
+        if self.output_order == BDL:
+            return lbd2bdl(post_lstm)
+        return post_lstm
+
+    def packed(self, seq, lengths, h0, c0):
+        """Run the LSTM on the LBD batch seq as a packed sequence."""
+        l, bs, d = seq.size()
+        order = np.argsort(-lengths, kind="mergesort")
+        index = torch.from_numpy(order).long()
+        inverse = torch.from_numpy(np.argsort(order)).long()
+        if data(seq).is_cuda:
+            device = data(seq).get_device()
+            index, inverse = index.cuda(device), inverse.cuda(device)
+        sorted_seq = seq.index_select(1, Variable(index))
+        packed = nn.utils.rnn.pack_padded_sequence(sorted_seq,
+                                                   [int(n) for n in lengths[order]])
+        post_lstm, _ = self.lstm(packed, (h0, c0))
+        post_lstm, _ = nn.utils.rnn.pad_packed_sequence(post_lstm)
+        if post_lstm.size(0) < l:
+            padding = data(post_lstm).new(l - post_lstm.size(0), bs, post_lstm.size(2))
+            padding = Variable(padding.zero_(), requires_grad=False)
+            post_lstm = torch.cat([post_lstm, padding], 0)
+        return post_lstm.index_select(1, Variable(inverse))
+
+    def carried(self, state, zero, volatile):
+        if self.ndir == 1:
+            return Variable(state, volatile=volatile)
+        return Variable(torch.cat([state[:1], data(zero)[1:]], 0), volatile=volatile)
+
+    def set_stateful(self, stateful=True):
+        """Turn carrying the LSTM state across calls on or off."""
+        self.stateful = stateful
+        self.reset_state()
+
+    def reset_state(self):
+        """Forget the carried state; the next call starts from zero."""
+        self.__dict__.pop("_carry", None)
 
     def __repr__(self):
         return "LSTM1:"+self.lstm.__repr__()
@@ -347,7 +574,7 @@ class LSTM1(nn.Module):
 
 
 
-class LSTM2to1(nn.Module):
+class LSTM2to1(ZeroStates, nn.Module):
     """An LSTM that summarizes one dimension."""
     input_order = BDWH
     output_order = BDL
@@ -361,28 +588,25 @@ class LSTM2to1(nn.Module):
     def forward(self, img, volatile=False):
         # BDWH -> HBWD -> HBsD
         b, d, w, h = img.size()
-        seq = img.permute(3, 0, 2, 1).contiguous().view(h, b * w, d)
+        seq = contiguous(img.permute(3, 0, 2, 1)).view(h, b * w, d)
         bs = b * w
-        h0 = Variable(
-            helpers.typeas(torch.zeros(1, bs, self.noutput), img), volatile=volatile)
-        c0 = Variable(
-            helpers.typeas(torch.zeros(1, bs, self.noutput), img), volatile=volatile)
+        h0, c0 = self.zero_states(1, bs, img, volatile)
         # HBsD -> HBsD
         assert seq.size() == (h, b * w, d), (seq.size(), (h, b * w, d))
-        post_lstm, _ = self.lstm(seq, (h0, c0))
+        post_lstm, _ = self.lstm(seq, self.lstm_states((h0, c0)))
         assert post_lstm.size() == (h, b * w, self.noutput), (post_lstm.size(),
                                                               (h, b * w, self.noutput))
         # HBsD -> BsD -> BWD
         final = post_lstm.select(0, h - 1).view(b, w, self.noutput)
         assert final.size() == (b, w, self.noutput), (final.size(), (b, w, self.noutput))
         # BWD -> BDW
-        final = final.permute(0, 2, 1).contiguous()
+        final = contiguous(final.permute(0, 2, 1))
         assert final.size() == (b, self.noutput, w), (final.size(),
                                                       (b, self.noutput, self.noutput))
         return final
 
 
-class LSTM1to0(nn.Module):
+class LSTM1to0(ZeroStates, nn.Module):
     """An LSTM that summarizes one dimension."""
     input_order = BDL
     output_order = BD
@@ -398,18 +622,44 @@ class LSTM1to0(nn.Module):
         seq = bdl2lbd(seq)
         l, b, d = seq.size()
         assert d == self.ninput, (d, self.ninput)
-        h0 = Variable(
-            helpers.typeas(torch.zeros(1, b, self.noutput), seq), volatile=volatile)
-        c0 = Variable(
-            helpers.typeas(torch.zeros(1, b, self.noutput), seq), volatile=volatile)
+        h0, c0 = self.zero_states(1, b, seq, volatile)
         assert seq.size() == (l, b, d)
-        post_lstm, _ = self.lstm(seq, (h0, c0))
+        post_lstm, _ = self.lstm(seq, self.lstm_states((h0, c0)))
         assert post_lstm.size() == (l, b, self.noutput)
         final = post_lstm.select(0, l - 1).view(b, self.noutput)
         return final
 
 
-class RowwiseLSTM(nn.Module):
+_strip_pools = {}
+
+def strip_pool(threads):
+    """A shared thread pool for strip execution."""
+    pool = _strip_pools.get(threads)
+    if pool is None:
+        pool = _strip_pools[threads] = ThreadPool(threads)
+    return pool
+
+class RowwiseLSTM(ZeroStates, nn.Module):
+    """Runs an LSTM along W over each row of a BDHW image.
+
+    In strip mode (`set_strips`), the rows are processed in groups of
+    at most `strip_rows` rows, so that the temporary copies and LSTM
+    states are bounded by the strip size rather than the image size.
+    Without gradients (volatile inputs), strips are written into a
+    preallocated output and, on CPU, can be spread over `strip_threads`
+    threads.
+
+    Strips are not bit-exact: each row goes through the same
+    computation, but BLAS may block the smaller batch of a strip
+    differently, so results can differ from whole images in the last
+    bits (test-trainers.ipynb checks them to 1e-6). With gradients,
+    the strips are concatenated and the graph of every strip is kept
+    until the backward pass, so strips only bound memory in inference;
+    training memory still grows with the image.
+    """
+    strip_rows = None
+    strip_threads = 0
+
     def __init__(self, ninput=None, noutput=None, ndir=2):
         nn.Module.__init__(self)
         self.ndir = ndir
@@ -417,25 +667,61 @@ class RowwiseLSTM(nn.Module):
         self.noutput = noutput
         self.lstm = nn.LSTM(ninput, noutput, 1, bidirectional=self.ndir - 1)
 
-    def forward(self, img):
-        volatile = not isinstance(img, Variable) or img.volatile
+    def set_strips(self, rows=None, threads=0):
+        """Process at most `rows` rows at a time; None turns strips off."""
+        assert rows is None or rows > 0, rows
+        self.strip_rows = rows
+        self.strip_threads = threads
+
+    def strips(self, h):
+        if self.strip_rows is None:
+            return [(0, h)]
+        return [(lo, min(h, lo + self.strip_rows)) for lo in range(0, h, self.strip_rows)]
+
+    def rows(self, img, volatile, states=None):
         b, d, h, w = img.size()
         # BDHW -> WHBD -> WB'D
-        seq = img.permute(3, 2, 0, 1).contiguous().view(w, h * b, d)
+        seq = contiguous(img.permute(3, 2, 0, 1)).view(w, h * b, d)
         # WB'D
-        h0 = helpers.typeas(torch.zeros(self.ndir, h * b, self.noutput), img)
-        c0 = helpers.typeas(torch.zeros(self.ndir, h * b, self.noutput), img)
-        h0 = Variable(h0, volatile=volatile)
-        c0 = Variable(c0, volatile=volatile)
-        seqresult, _ = self.lstm(seq, (h0, c0))
+        h0, c0 = states or self.zero_states(self.ndir, h * b, img, volatile)
+        seqresult, _ = self.lstm(seq, self.lstm_states((h0, c0)))
         # WB'D' -> BD'HW
         result = seqresult.view(
             w, h, b, self.noutput * self.ndir).permute(2, 3, 1, 0)
         return result
 
+    def forward(self, img, out=None):
+        volatile = not isinstance(img, Variable) or img.volatile
+        b, d, h, w = img.size()
+        strips = self.strips(h)
+        if len(strips) == 1 and out is None:
+            return self.rows(img, volatile)
+        if not volatile:
+            assert out is None, "out requires a volatile input"
+            return torch.cat([self.rows(img[:, :, lo:hi], False) for lo, hi in strips], 2)
+        if out is None:
+            out = data(img).new(b, self.noutput * self.ndir, h, w)
+        states = dict((hi - lo, self.zero_states(self.ndir, (hi - lo) * b, img, True))
+                      for lo, hi in strips)
+        def run(bounds):
+            lo, hi = bounds
+            result = self.rows(img[:, :, lo:hi], True, states[hi - lo])
+            out[:, :, lo:hi].copy_(data(result))
+        if self.strip_threads > 1 and not data(img).is_cuda:
+            strip_pool(self.strip_threads).map(run, strips)
+        else:
+            for bounds in strips:
+                run(bounds)
+        return Variable(out, volatile=True)
+
 
 class LSTM2(nn.Module):
-    """A 2D LSTM module."""
+    """A 2D LSTM module.
+
+    `set_strips` bounds the memory used by both directions in
+    inference (see `RowwiseLSTM`); the vertical pass then writes
+    directly into the output.
+    """
 
     def __init__(self, ninput=None, noutput=None, nhidden=None, ndir=2):
         nn.Module.__init__(self)
@@ -444,10 +730,26 @@ class LSTM2(nn.Module):
         self.hlstm = RowwiseLSTM(ninput, nhidden, ndir=ndir)
         self.vlstm = RowwiseLSTM(nhidden * ndir, noutput, ndir=ndir)
 
+    def set_strips(self, rows=None, threads=0):
+        self.hlstm.set_strips(rows, threads)
+        self.vlstm.set_strips(rows, threads)
+
     def forward(self, img):
         horiz = self.hlstm(img)
-        horizT = horiz.permute(0, 1, 3, 2).contiguous()
+        # vlstm makes its own contiguous copy of its input
+        horizT = horiz.permute(0, 1, 3, 2)
+        if self.vlstm.strip_rows is not None and horiz.volatile:
+            b, d, h, w = img.size()
+            out = data(horiz).new(b, self.vlstm.noutput * self.vlstm.ndir, h, w)
+            self.vlstm(horizT, out=out.permute(0, 1, 3, 2))
+            return Variable(out, volatile=True)
         vert = self.vlstm(horizT)
-        vertT = vert.permute(0, 1, 3, 2).contiguous()
+        vertT = contiguous(vert.permute(0, 1, 3, 2))
         return vertT
 
+def set_strips(model, rows=None, threads=0):
+    """Turn on strip execution for all 2D LSTM layers in model."""
+    for module in model.modules():
+        if isinstance(module, RowwiseLSTM):
+            module.set_strips(rows, threads)
+
@@ -0,0 +1,147 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Layout optimization for sequential models.
+
+`optimize_layout` rewrites the `nn.Sequential` containers in a model
+using the `input_order`/`output_order` annotations of the layers:
+
+- adjacent `Reorder`/`Permute` modules are fused, and removed if the
+  result is the identity
+- a `Reorder` next to a layer that can produce or consume the
+  reordered layout directly (e.g., `LSTM1` in LBD order) is folded
+  into that layer
+- stacked layers that share a native layout (e.g., `LSTM1` -> `LSTM1`)
+  pass tensors in that layout instead of converting back and forth
+- a permutation followed by a layer that makes its own contiguous copy
+  no longer copies
+
+The outputs of the model are unchanged.
+"""
+
+import torch
+from torch import nn
+from torch.autograd import Variable
+import layers
+import flex
+
+def inner(module):
+    """Look through built Flex wrappers."""
+    if isinstance(module, flex.Flex) and module.layer is not None:
+        return module.layer
+    return module
+
+def permutation_of(module):
+    if isinstance(module, (layers.Reorder, layers.Permute)):
+        return tuple(module.permutation)
+    return None
+
+def copies_input(module):
+    """Whether module makes a contiguous copy of its input anyway."""
+    if isinstance(module, (layers.Reorder, layers.Permute)):
+        return getattr(module, "make_contiguous", True)
+    if isinstance(module, layers.LSTM1):
+        return module.input_order == layers.BDL
+    return isinstance(module, (layers.Img2Seq, layers.RowwiseLSTM, layers.LSTM2,
+                               layers.LSTM2to1, layers.PixelsToBatch))
+
+def fused_module(a, b, permutation):
+    if isinstance(a, layers.Reorder) and isinstance(b, layers.Reorder) and a.new == b.old:
+        return layers.Reorder(a.old, b.new)
+    return layers.Permute(*permutation)
+
+def native_order(module):
+    if isinstance(module, layers.LSTM1):
+        return layers.LBD
+    return None
+
+def _rewrite_pair(seq, a_key, b_key, changes):
+    """Apply the first matching rewrite to a pair of modules."""
+    a, b = inner(seq._modules[a_key]), inner(seq._modules[b_key])
+    pa, pb = permutation_of(a), permutation_of(b)
+    if pa is not None and pb is not None:
+        fused = tuple(pa[i] for i in pb)
+        del seq._modules[b_key]
+        if fused == tuple(range(len(fused))):
+            del seq._modules[a_key]
+            changes.append("removed {} + {}".format(a, b))
+        else:
+            seq._modules[a_key] = fused_module(a, b, fused)
+            changes.append("fused {} + {}".format(a, b))
+        return True
+    if isinstance(b, layers.Reorder) and hasattr(a, "output_orders"):
+        if b.old == a.output_order and b.new in a.output_orders:
+            a.output_order = b.new
+            del seq._modules[b_key]
+            changes.append("folded {} into output of {}".format(b, a))
+            return True
+    if isinstance(a, layers.Reorder) and hasattr(b, "input_orders"):
+        if a.new == b.input_order and a.old in b.input_orders:
+            b.input_order = a.old
+            del seq._modules[a_key]
+            changes.append("folded {} into input of {}".format(a, b))
+            return True
+    order = native_order(a)
+    if order is not None and order == native_order(b):
+        if a.output_order == b.input_order and a.output_order != order:
+            if order in a.output_orders and order in b.input_orders:
+                a.output_order = order
+                b.input_order = order
+                changes.append("passing {} between {} and {}".format(order, a, b))
+                return True
+    return False
+
+def optimize_sequential(seq, changes):
+    while True:
+        keys = list(seq._modules.keys())
+        for a_key, b_key in zip(keys[:-1], keys[1:]):
+            if _rewrite_pair(seq, a_key, b_key, changes):
+                break
+        else:
+            break
+    keys = list(seq._modules.keys())
+    for a_key, b_key in zip(keys[:-1], keys[1:]):
+        a, b = inner(seq._modules[a_key]), inner(seq._modules[b_key])
+        if permutation_of(a) is not None and copies_input(b):
+            if getattr(a, "make_contiguous", True):
+                a.make_contiguous = False
+                changes.append("no copy in {} before {}".format(a, b))
+
+def optimize_modules(model, changes):
+    if isinstance(model, nn.Sequential):
+        optimize_sequential(model, changes)
+    for child in list(model.children()):
+        optimize_modules(inner(child), changes)
+
+def measure_copies(model, input_shape):
+    """Count the contiguous copies made by layers in one forward pass."""
+    training = model.training
+    model.eval()
+    parameters = list(model.parameters())
+    x = torch.zeros(*input_shape)
+    if len(parameters) > 0:
+        x = x.type_as(parameters[0].data)
+    layers.copy_stats.update(count=0, bytes=0)
+    model(Variable(x, volatile=True))
+    model.train(training)
+    return dict(layers.copy_stats)
+
+def optimize_layout(model, input_shape=None):
+    """Optimize the tensor layouts in the Sequential containers of model.
+
+    The model is modified in place. Returns a report with the list of
+    changes; if an input shape is given, the report also gives the
+    number of copies and bytes copied per forward pass before and
+    after optimization, and the bytes saved.
+    """
+    report = dict(changes=[])
+    if input_shape is not None:
+        flex.flex_build(model, input_shape)
+        before = measure_copies(model, input_shape)
+    optimize_modules(model, report["changes"])
+    if input_shape is not None:
+        after = measure_copies(model, input_shape)
+        report.update(copies_before=before["count"], copies_after=after["count"],
+                      bytes_before=before["bytes"], bytes_after=after["bytes"],
+                      bytes_saved=before["bytes"] - after["bytes"])
+    return report
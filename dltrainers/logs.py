@@ -0,0 +1,319 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Columnar training logs.
+
+A `TrainingLog` keeps one buffer per log name ("train", "eval", ...),
+with one NumPy column per logged key. Appends are amortized O(1) and
+lookups by log name are direct. By default, the buffers grow and keep
+every record, like the old list-based logs. With a capacity, they are
+ring buffers: when one is full, the oldest records are overwritten;
+if a spill file is given, they are written to it first (SQLite, or a
+series of .npz files).
+"""
+
+import glob
+import numbers
+import platform
+import sqlite3
+import time
+from collections import OrderedDict
+import numpy as np
+
+class RingBuffer(object):
+    """A buffer of records, stored column by column.
+
+    With a capacity, only the newest capacity records are retained;
+    with capacity None, the columns grow by doubling.
+    """
+
+    def __init__(self, capacity=None, initial=1024):
+        assert capacity is None or capacity > 0, capacity
+        self.capacity = capacity
+        self.allocated = capacity or initial
+        self.columns = OrderedDict()
+        self.count = 0
+
+    def __len__(self):
+        return self.count - self.first()
+
+    def first(self):
+        """The number of the oldest retained record."""
+        if self.capacity is None:
+            return 0
+        return max(0, self.count - self.capacity)
+
+    def _new_column(self, numeric):
+        if numeric:
+            column = np.empty(self.allocated, "d")
+            column.fill(np.nan)
+        else:
+            column = np.empty(self.allocated, object)
+        return column
+
+    def _grow(self):
+        old = self.allocated
+        self.allocated *= 2
+        for key, column in self.columns.items():
+            grown = self._new_column(column.dtype != object)
+            grown[:old] = column
+            self.columns[key] = grown
+
+    def append(self, **kw):
+        if self.capacity is None and self.count >= self.allocated:
+            self._grow()
+        i = self.count % self.allocated
+        for key, value in kw.items():
+            numeric = isinstance(value, numbers.Real)
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = self._new_column(numeric)
+            elif not numeric and column.dtype != object:
+                column = self.columns[key] = column.astype(object)
+            column[i] = value
+        for key, column in self.columns.items():
+            if key not in kw:
+                column[i] = np.nan if column.dtype != object else None
+        self.count += 1
+
+    def indexes(self, start=None):
+        """Storage indexes of the retained records from number start on."""
+        first = self.first()
+        start = first if start is None else max(start, first)
+        return np.arange(start, self.count) % self.allocated
+
+    @classmethod
+    def from_columns(cls, capacity, columns):
+        """A buffer holding the given retained columns (oldest first)."""
+        buffer = cls(capacity)
+        if capacity is None:
+            sizes = [len(values) for values in columns.values()]
+            buffer.allocated = max([buffer.allocated] + sizes)
+        for key, values in columns.items():
+            n = len(values)
+            assert n <= buffer.allocated, (n, buffer.allocated)
+            column = buffer.columns[key] = buffer._new_column(values.dtype != object)
+            column[:n] = values
+            buffer.count = n
+        return buffer
+
+    def column(self, key, start=None):
+        """The values of key for the retained records, oldest first."""
+        index = self.indexes(start)
+        if key not in self.columns:
+            result = np.empty(len(index), "d")
+            result.fill(np.nan)
+            return result
+        return self.columns[key][index]
+
+class SqliteSpill(object):
+    """Stores spilled log records in an SQLite file."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("create table if not exists records "
+                        "(log text, n integer, key text, value)")
+        self.db.execute("create index if not exists records_log "
+                        "on records (log, key, n)")
+
+    def write(self, logname, start, columns):
+        rows = []
+        for key, values in columns.items():
+            for i, value in enumerate(values):
+                if isinstance(value, numbers.Real):
+                    value = float(value)
+                elif value is not None:
+                    value = str(value)
+                rows.append((logname, start + i, key, value))
+        self.db.executemany("insert into records values (?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def read(self, logname, key):
+        rows = self.db.execute("select value from records where log=? and key=? "
+                               "order by n", (logname, key)).fetchall()
+        values = [r[0] for r in rows]
+        if all(v is None or isinstance(v, float) for v in values):
+            # SQLite stores NaN as NULL
+            return np.array([np.nan if v is None else v for v in values], "d")
+        return np.array(values)
+
+class NpzSpill(object):
+    """Stores spilled log records as a series of .npz files."""
+
+    def __init__(self, path):
+        assert path.endswith(".npz"), path
+        self.prefix = path[:-4]
+
+    def write(self, logname, start, columns):
+        fname = "{}-{}-{:012d}.npz".format(self.prefix, logname, start)
+        np.savez(fname, **columns)
+
+    def read(self, logname, key):
+        fnames = sorted(glob.glob("{}-{}-*.npz".format(self.prefix, logname)))
+        chunks = []
+        for fname in fnames:
+            data = np.load(fname, allow_pickle=True)
+            if key in data.files:
+                chunks.append(data[key])
+        if len(chunks) == 0:
+            return np.zeros(0)
+        return np.concatenate(chunks)
+
+def open_spill(path):
+    """Open a spill file; the format is chosen by the extension."""
+    if path.endswith(".npz"):
+        return NpzSpill(path)
+    return SqliteSpill(path)
+
+def minmax_downsample(x, y, maxpoints):
+    """Reduce a curve to about maxpoints points, keeping minima and maxima."""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(x)
+    if maxpoints is None or n <= maxpoints:
+        return x, y
+    nbins = max(1, maxpoints // 2)
+    edges = np.linspace(0, n, nbins + 1).astype(int)
+    index = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if hi <= lo:
+            continue
+        a = lo + np.argmin(y[lo:hi])
+        b = lo + np.argmax(y[lo:hi])
+        index += sorted(set([a, b]))
+    return x[index], y[index]
+
+def decimate(x, y, maxpoints):
+    """Reduce a curve to at most maxpoints points by taking every k-th."""
+    n = len(x)
+    if maxpoints is None or n <= maxpoints:
+        return np.asarray(x), np.asarray(y)
+    step = int(np.ceil(n * 1.0 / maxpoints))
+    return np.asarray(x)[::step], np.asarray(y)[::step]
+
+class TrainingLog(object):
+    """A columnar training log with one buffer per log name.
+
+    Iterating over the log yields record dicts like the old list-based
+    logs (with `__log__`, `__at__` and `__node__` keys), and `append`
+    accepts such records. With capacity None (the default), every
+    record is kept; otherwise, each log retains the newest capacity
+    records, and older ones are only kept in the spill file, if any.
+    """
+
+    def __init__(self, capacity=None, spill=None):
+        self.capacity = capacity
+        self.buffers = OrderedDict()
+        self.spilled = {}
+        self.node = platform.node()
+        if isinstance(spill, str):
+            spill = open_spill(spill)
+        self.spill = spill
+
+    def __len__(self):
+        return sum(len(b) for b in self.buffers.values())
+
+    def names(self):
+        return list(self.buffers.keys())
+
+    def add(self, logname, **kw):
+        """Append a record to the named log."""
+        buffer = self.buffers.get(logname)
+        if buffer is None:
+            buffer = self.buffers[logname] = RingBuffer(self.capacity)
+        if self.spill is not None and self.capacity is not None:
+            if buffer.count - self.spilled.get(logname, 0) >= self.capacity:
+                self.flush(logname)
+        kw.setdefault("__at__", time.time())
+        buffer.append(**kw)
+
+    def append(self, entry):
+        """Append a record in the old dict format."""
+        entry = dict(entry)
+        logname = entry.pop("__log__")
+        entry.pop("__node__", None)
+        self.add(logname, **entry)
+
+    def flush(self, logname=None):
+        """Write records that have not been spilled yet to the spill file."""
+        if self.spill is None:
+            return
+        names = self.names() if logname is None else [logname]
+        for name in names:
+            buffer = self.buffers[name]
+            start = self.spilled.get(name, 0)
+            if start >= buffer.count:
+                continue
+            columns = dict((key, buffer.column(key, start))
+                           for key in buffer.columns.keys())
+            self.spill.write(name, max(start, buffer.first()), columns)
+            self.spilled[name] = buffer.count
+
+    def snapshot(self):
+        """Copy the retained records, as {logname: {key: column}}."""
+        return OrderedDict((name, OrderedDict((key, buffer.column(key))
+                                              for key in buffer.columns.keys()))
+                           for name, buffer in self.buffers.items())
+
+    @classmethod
+    def from_snapshot(cls, snapshot, capacity=None, spill=None):
+        """A log holding the records of a snapshot."""
+        log = cls(capacity=capacity, spill=spill)
+        for name, columns in snapshot.items():
+            log.buffers[name] = RingBuffer.from_columns(capacity, columns)
+        return log
+
+    def column(self, logname, key, spilled=False):
+        """Return the values of key in the named log, oldest first.
+
+        With spilled=True, records that were already spilled to disk
+        are included.
+        """
+        buffer = self.buffers.get(logname)
+        if buffer is None:
+            return np.zeros(0)
+        if not spilled or self.spill is None:
+            return buffer.column(key)
+        self.flush(logname)
+        return self.spill.read(logname, key)
+
+    def records(self, logname):
+        """Return the retained records of the named log as dicts."""
+        buffer = self.buffers.get(logname)
+        if buffer is None:
+            return []
+        keys = list(buffer.columns.keys())
+        columns = [buffer.column(key) for key in keys]
+        result = []
+        for values in zip(*columns):
+            record = dict((k, v) for k, v in zip(keys, values)
+                          if not (v is None or (isinstance(v, float) and np.isnan(v))))
+            record.update(__log__=logname, __node__=self.node)
+            result.append(record)
+        return result
+
+    def __iter__(self):
+        for logname in self.names():
+            for record in self.records(logname):
+                yield record
+
+    def curve(self, logname, x="ntrain", y="loss", maxpoints=None,
+              mode="minmax", spilled=False):
+        """Return a (possibly downsampled) curve of y against x.
+
+        The mode is either "minmax" (keep the extrema in each bin) or
+        "decimate" (keep every k-th point).
+        """
+        xs = self.column(logname, x, spilled=spilled).astype("d")
+        ys = self.column(logname, y, spilled=spilled).astype("d")
+        valid = ~(np.isnan(xs) | np.isnan(ys))
+        xs, ys = xs[valid], ys[valid]
+        if len(xs) > 1 and np.any(xs[1:] < xs[:-1]):
+            order = np.argsort(xs, kind="mergesort")
+            xs, ys = xs[order], ys[order]
+        if mode == "minmax":
+            return minmax_downsample(xs, ys, maxpoints)
+        elif mode == "decimate":
+            return decimate(xs, ys, maxpoints)
+        else:
+            raise ValueError("{}: unknown downsampling mode".format(mode))
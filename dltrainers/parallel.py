@@ -0,0 +1,184 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Data-parallel training on local CPU cores.
+
+`DataParallel` forks worker processes that each hold a replica of a
+trainer's model. Each call to `train_batch` splits the batch into one
+shard per process (the calling process is rank 0). Every process runs
+the forward and backward passes on its shard. The gradients are then
+summed over a `torch.distributed` gloo group on localhost before each
+optimizer step. Because all replicas start from the same parameters
+and apply the same updates, they stay identical.
+
+Use it through `BasicTrainer.set_data_parallel`.
+"""
+
+import multiprocessing
+import socket
+import traceback
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing
+import helpers as dlh
+import flex
+
+def free_port():
+    """Return a TCP port on localhost that is currently unused."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def init_group(rank, world_size, port):
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:{}".format(port),
+                            rank=rank, world_size=world_size)
+
+def broadcast_parameters(model, root=0):
+    """Make the parameters of model equal to those of rank root."""
+    for p in model.parameters():
+        dist.broadcast(p.data, root)
+
+def allreduce_gradients(model):
+    """Sum the gradients of model over all processes, in one transfer."""
+    grads = [p.grad.data for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([g.contiguous().view(-1) for g in grads])
+    dist.all_reduce(flat)
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+def shard_bounds(n, nprocs):
+    bounds = np.linspace(0, n, nprocs + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def hyperparameters(optimizer):
+    """The settings of each parameter group, without the parameters."""
+    return [dict((k, v) for k, v in group.items() if k != "params")
+            for group in optimizer.param_groups]
+
+def shard_step(trainer, inputs, targets, weights, scale, zero):
+    """Forward and backward on one shard; returns the unscaled loss."""
+    trainer.set_training(True)
+    if zero:
+        trainer.optimizer.zero_grad()
+    culoss = trainer.batch_loss(inputs, targets, weights)
+    trainer.backward(culoss * scale)
+    return dlh.novar(culoss)
+
+def _worker(trainer, rank, world_size, port, conn, threads):
+    if threads is not None and hasattr(torch, "set_num_threads"):
+        torch.set_num_threads(threads)
+    trainer.parallel = None
+    init_group(rank, world_size, port)
+    broadcast_parameters(trainer.model)
+    while True:
+        command = conn.recv()
+        if command is None:
+            break
+        inputs, targets, weights, info, scale, zero, step, groups = command
+        try:
+            for group, settings in zip(trainer.optimizer.param_groups, groups):
+                group.update(settings)
+            trainer.set_batch_info(info)
+            culoss = shard_step(trainer, inputs, targets, weights, scale, zero)
+            conn.send((dlh.scalar(culoss), dlh.asnd(trainer.cuoutput)))
+        except Exception:
+            conn.send(traceback.format_exc())
+            break
+        if step:
+            allreduce_gradients(trainer.model)
+            trainer.optimizer.step()
+    conn.close()
+
+class DataParallel(object):
+    """Runs the training steps of a CPU trainer on nprocs local processes.
+
+    `threads` sets the number of torch threads per process; by default,
+    the cores are divided evenly between the processes.
+    """
+
+    def __init__(self, trainer, nprocs, threads=None, port=None):
+        assert nprocs > 1, nprocs
+        assert not trainer.use_cuda, "data-parallel training is for CPU trainers"
+        # replicas would create different random layers on their first forward pass
+        assert len(flex.flex_unbuilt(trainer.model)) == 0, \
+            "build the Flex layers first (input_shape or flex.flex_build)"
+        self.nprocs = nprocs
+        if threads is None:
+            threads = max(1, multiprocessing.cpu_count() // nprocs)
+        port = port or free_port()
+        self.conns = []
+        self.procs = []
+        for rank in range(1, nprocs):
+            parent, child = torch.multiprocessing.Pipe()
+            proc = torch.multiprocessing.Process(
+                target=_worker, args=(trainer, rank, nprocs, port, child, threads))
+            proc.daemon = True
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        if hasattr(torch, "set_num_threads"):
+            torch.set_num_threads(threads)
+        init_group(0, nprocs, port)
+        broadcast_parameters(trainer.model)
+
+    def train_batch(self, trainer, inputs, targets, weights, zero, step):
+        """Run one training step; returns (loss, outputs) for the whole batch.
+
+        The gradients are only summed over the processes when `step` is
+        true, so that gradient accumulation works as in one process.
+        """
+        n = dlh.size(inputs, 0)
+        assert n >= self.nprocs, "batch smaller than the number of processes"
+        mean = trainer.loss_is_mean()
+        accumulate = max(1, trainer.accumulate)
+        groups = hyperparameters(trainer.optimizer)
+        shards = shard_bounds(n, self.nprocs)
+        scales = [(hi - lo) * 1.0 / n if mean else 1.0 for lo, hi in shards]
+        select = lambda x, lo, hi: None if x is None else x[lo:hi]
+        for conn, (lo, hi), scale in zip(self.conns, shards[1:], scales[1:]):
+            conn.send((inputs[lo:hi], targets[lo:hi], select(weights, lo, hi),
+                       trainer.shard_info(lo, hi),
+                       scale / accumulate if mean else scale, zero, step, groups))
+        lo, hi = shards[0]
+        info = trainer.shard_info(0, n)
+        trainer.set_batch_info(trainer.shard_info(lo, hi))
+        try:
+            culoss = shard_step(trainer, inputs[lo:hi], targets[lo:hi], select(weights, lo, hi),
+                                scales[0] / accumulate if mean else scales[0], zero)
+        finally:
+            trainer.set_batch_info(info)
+        total = dlh.scalar(culoss) * scales[0]
+        outputs = [dlh.novar(trainer.cuoutput)]
+        for conn, scale in zip(self.conns, scales[1:]):
+            reply = conn.recv()
+            if isinstance(reply, str):
+                self.close()
+                raise Exception("data-parallel worker failed:\n" + reply)
+            loss, output = reply
+            total += loss * scale
+            outputs.append(dlh.typeas(torch.from_numpy(output), outputs[0]))
+        if step:
+            allreduce_gradients(trainer.model)
+        return torch.FloatTensor([total]), torch.cat(outputs, 0)
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for proc in self.procs:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+        self.conns = []
+        self.procs = []
+        if hasattr(dist, "destroy_process_group"):
+            dist.destroy_process_group()
@@ -0,0 +1,155 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Background prefetching of training batches.
+
+A `Prefetcher` wraps an iterator over batches (dicts of fields, as
+used by `train_for`) and reads it in a background thread. The selected
+fields are converted to torch tensors by a pool of thread or process
+workers, so that decoding and conversion overlap with training.
+Fields that were arrays are returned as arrays again, backed by the
+pinned or shared memory of the tensors, so that the trainer handles
+them (e.g., transposes them) exactly like batches that were not
+prefetched.
+"""
+
+import threading
+import numpy as np
+import torch
+import torch.multiprocessing
+from multiprocessing.pool import ThreadPool
+import helpers as dlh
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+_done = object()
+
+class _Failure(object):
+    def __init__(self, exn):
+        self.exn = exn
+
+def convert_batch(batch, fields, pin_memory=False, share_memory=False):
+    """Convert the given fields of a batch to torch tensors.
+
+    Arrays are wrapped without copying and keep their dtype (see
+    `helpers.from_numpy`); the trainer converts them to its own type.
+    Narrow signed integers (e.g., int32 class labels) become int64, as
+    torch uses for indexes. Fields that are neither arrays nor tensors
+    (e.g., lists of target sequences) are left alone.
+    """
+    result = dict(batch)
+    for name in fields:
+        if name not in batch:
+            continue
+        value = dlh.novar(batch[name])
+        if isinstance(value, np.ndarray):
+            if value.dtype.kind == "i" and value.dtype.itemsize < 8:
+                value = value.astype("int64")
+            value = dlh.from_numpy(value)
+        elif not dlh.is_tensor(value):
+            continue
+        elif value.type() in narrow_int_types:
+            value = value.long()
+        if share_memory:
+            value = value.share_memory_()
+        if pin_memory:
+            value = value.pin_memory()
+        result[name] = value
+    return result
+
+narrow_int_types = set(["torch.CharTensor", "torch.ShortTensor", "torch.IntTensor"])
+
+class Converter(object):
+    """A picklable batch converter for worker pools.
+
+    Returns the converted batch and the names of the fields that
+    were arrays in the source batch.
+    """
+    def __init__(self, fields, pin_memory=False, share_memory=False):
+        self.fields = fields
+        self.pin_memory = pin_memory
+        self.share_memory = share_memory
+    def __call__(self, batch):
+        arrays = [name for name in self.fields
+                  if isinstance(batch.get(name), np.ndarray)]
+        return convert_batch(batch, self.fields,
+                             pin_memory=self.pin_memory,
+                             share_memory=self.share_memory), arrays
+
+class Prefetcher(object):
+    """Iterate over batches, converting them ahead of time in the background.
+
+    Up to `depth` batches are kept in flight. With mode="thread",
+    `workers` threads convert batches (and pin them if `pin_memory`);
+    with mode="process", conversion happens in worker processes and
+    the tensors are returned in shared memory. Batches are returned in
+    the order of the source.
+    """
+
+    def __init__(self, source, fields, depth=4, workers=1, mode="thread",
+                 pin_memory=False):
+        assert depth > 0, depth
+        self.source = iter(source)
+        self.mode = mode
+        self.pin_memory = pin_memory
+        if mode == "thread":
+            self.pool = ThreadPool(workers)
+            self.convert = Converter(fields, pin_memory=pin_memory)
+        elif mode == "process":
+            self.pool = torch.multiprocessing.Pool(workers)
+            self.convert = Converter(fields, share_memory=True)
+        else:
+            raise ValueError("{}: unknown prefetch mode".format(mode))
+        self.fields = fields
+        self.queue = queue.Queue(depth)
+        self.stopped = False
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            for batch in self.source:
+                if self.stopped:
+                    break
+                self.queue.put(self.pool.apply_async(self.convert, (batch,)))
+        except Exception as exn:
+            self.queue.put(_Failure(exn))
+        self.queue.put(_done)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.stopped:
+            raise StopIteration
+        item = self.queue.get()
+        if item is _done:
+            self.close()
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self.close()
+            raise item.exn
+        batch, arrays = item.get()
+        if self.mode == "process" and self.pin_memory:
+            for name in self.fields:
+                if dlh.is_tensor(batch.get(name)):
+                    batch[name] = batch[name].pin_memory()
+        for name in arrays:
+            batch[name] = batch[name].numpy()
+        return batch
+
+    __next__ = next
+
+    def close(self):
+        """Stop the background reader and shut down the workers."""
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.pool.terminate()
@@ -0,0 +1,132 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Timing of trainer stages and model layers.
+
+A `Profiler` collects durations for named stages (recent samples are
+kept per name) and can attach forward and backward hooks to the
+submodules of a model. Trainers use `null_stage` when profiling is
+off, so that the instrumentation costs next to nothing.
+"""
+
+import time
+from collections import defaultdict, deque
+import numpy as np
+import torch
+
+class NullStage(object):
+    """A do-nothing context manager used when profiling is off."""
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+null_stage = NullStage()
+
+class Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+    def __enter__(self):
+        self.start = self.profiler.timer()
+        return self
+    def __exit__(self, *args):
+        self.profiler.record(self.name, self.profiler.timer() - self.start)
+        return False
+
+def synchronized_timer():
+    """A timer that waits for pending CUDA work before reading the clock."""
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.time()
+
+class Profiler(object):
+    """Collects stage and layer timings.
+
+    `timer` is a function returning the current time in seconds; use
+    `synchronized_timer` to time asynchronous CUDA work. The last
+    `keep` samples are kept for each name.
+    """
+
+    def __init__(self, timer=time.time, keep=1000):
+        self.timer = timer
+        self.keep = keep
+        self.samples = defaultdict(lambda: deque(maxlen=self.keep))
+        self.current = {}
+        self.hooks = []
+        self.starts = defaultdict(list)
+        self.last_backward = None
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def record(self, name, duration):
+        self.samples[name].append(duration)
+        self.current[name] = self.current.get(name, 0.0) + duration
+
+    def end_step(self):
+        """Return the durations recorded since the last call."""
+        result = self.current
+        self.current = {}
+        return result
+
+    def begin_backward(self):
+        self.last_backward = self.timer()
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self.starts[name].append(self.timer())
+        return hook
+
+    def _forward_hook(self, name):
+        def hook(module, inputs, output):
+            if self.starts[name]:
+                self.record("forward:" + name, self.timer() - self.starts[name].pop())
+        return hook
+
+    def _backward_hook(self, name):
+        def hook(module, grad_input, grad_output):
+            if self.last_backward is not None:
+                now = self.timer()
+                self.record("backward:" + name, now - self.last_backward)
+                self.last_backward = now
+        return hook
+
+    def attach(self, model):
+        """Time the forward and backward passes of each submodule of model.
+
+        Backward times are measured between successive backward hooks,
+        so they are approximate.
+        """
+        self.detach()
+        for name, module in model.named_modules():
+            if name == "":
+                continue
+            if hasattr(module, "register_forward_pre_hook"):
+                self.hooks.append(module.register_forward_pre_hook(self._pre_hook(name)))
+                self.hooks.append(module.register_forward_hook(self._forward_hook(name)))
+            self.hooks.append(module.register_backward_hook(self._backward_hook(name)))
+
+    def detach(self):
+        for handle in self.hooks:
+            handle.remove()
+        self.hooks = []
+
+    def percentiles(self, name, ps=(50, 90, 99)):
+        values = np.array(self.samples[name])
+        if len(values) == 0:
+            return dict(("p{}".format(p), 0.0) for p in ps)
+        return dict(("p{}".format(p), float(np.percentile(values, p))) for p in ps)
+
+    def histogram(self, name, bins=20):
+        """Return (counts, edges) for the recent samples of name."""
+        return np.histogram(np.array(self.samples[name]), bins=bins)
+
+    def summary(self, ps=(50, 90, 99)):
+        """Return count, mean and percentiles (in seconds) for each name."""
+        result = {}
+        for name, values in self.samples.items():
+            entry = dict(count=len(values), mean=float(np.mean(values)))
+            entry.update(self.percentiles(name, ps))
+            result[name] = entry
+        return result
@@ -0,0 +1,239 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""Parallel reading of training data from SQLite files.
+
+`SqliteReader` reads tables with the layout of `testdata/sample.db`,
+i.e. `train(image blob, cls integer, inx integer)`, and yields batches
+as dicts of arrays, ready for `train_for`:
+
+    reader = SqliteReader("testdata/sample.db", batch_size=32, epochs=10)
+    trainer.set_sample_fields("image", "cls")
+    trainer.train_for(reader)
+
+The key column (inx) is split into ranges of `chunk_size` rows. Each
+epoch visits the ranges in a new random order, and the rows are
+shuffled again in a buffer. Only the keys are loaded up front. Worker
+processes each hold their own connection, read whole ranges, and
+decode the image blobs.
+
+With a `cache_dir`, the decoded samples of the first epoch are written
+to a memory-mapped shard cache (see `samplecache`), and later epochs,
+as well as later runs with the same file and decode parameters, are
+served from it. Data that cannot be cached (e.g., images of varying
+size) is read from the file in every epoch instead.
+"""
+
+import io
+import multiprocessing
+import numbers
+import os
+import random
+import re
+import sqlite3
+import numpy as np
+import samplecache
+
+def decode_image(blob, mode="gray"):
+    """Decode an image blob to a float32 HWD array with values in [0, 1]."""
+    import PIL.Image
+    image = PIL.Image.open(io.BytesIO(bytes(blob)))
+    if mode == "gray":
+        image = image.convert("L")
+    elif mode == "rgb":
+        image = image.convert("RGB")
+    result = np.asarray(image, "f") / 255.0
+    if result.ndim == 2:
+        result = result[:, :, np.newaxis]
+    return result
+
+def identifier(name):
+    assert re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", name), name
+    return name
+
+def has_index(db, table, column):
+    """Whether some index of table starts with column."""
+    for (index,) in db.execute("select name from sqlite_master "
+                               "where type='index' and tbl_name=?", (table,)):
+        info = db.execute("pragma index_info({})".format(identifier(index))).fetchall()
+        if len(info) > 0 and info[0][2] == column:
+            return True
+    return False
+
+def key_column(db, table, key):
+    """The key for range reads: key if it is indexed, else rowid."""
+    if key == "rowid" or has_index(db, table, key):
+        return key
+    return "rowid"
+
+def chunk_ranges(keys, chunk_size):
+    """Split sorted keys into (lo, hi) ranges of chunk_size keys (hi inclusive)."""
+    return [(keys[i], keys[min(i + chunk_size, len(keys)) - 1])
+            for i in range(0, len(keys), chunk_size)]
+
+# connections by (pid, fname); SQLite connections must not be shared across fork
+_worker_db = {}
+
+def _connection(fname):
+    key = (os.getpid(), fname)
+    db = _worker_db.get(key)
+    if db is None:
+        db = _worker_db[key] = sqlite3.connect(fname)
+    return db
+
+def close_connections():
+    """Close the connections opened by this process."""
+    pid = os.getpid()
+    for key in [k for k in _worker_db.keys() if k[0] == pid]:
+        _worker_db.pop(key).close()
+
+class ChunkReader(object):
+    """Reads and decodes the rows of one key range; runs in the workers."""
+
+    def __init__(self, fname, table, key, decode):
+        self.fname = fname
+        self.query = "select * from {} where {} >= ? and {} <= ? order by {}".format(
+            identifier(table), identifier(key), identifier(key), identifier(key))
+        self.decode = decode
+
+    def __call__(self, bounds):
+        cursor = _connection(self.fname).execute(self.query, bounds)
+        names = [d[0] for d in cursor.description]
+        samples = []
+        for row in cursor:
+            sample = dict(zip(names, row))
+            for name, mode in self.decode.items():
+                if name in sample:
+                    sample[name] = decode_image(sample[name], mode)
+            samples.append(sample)
+        return samples
+
+def collate(samples):
+    """Turn a list of sample dicts into a dict of arrays (or lists)."""
+    batch = {}
+    for name in samples[0].keys():
+        values = [s[name] for s in samples]
+        if isinstance(values[0], (np.ndarray, numbers.Number)):
+            try:
+                batch[name] = np.array(values)
+                continue
+            except ValueError:
+                pass
+        batch[name] = values
+    return batch
+
+class SqliteReader(object):
+    """Iterate over batches from an SQLite table, reading in parallel.
+
+    `decode` maps blob columns to image modes ("gray", "rgb", or None
+    to keep the file's mode). With workers=0, everything runs in the
+    calling process. The last partial batch of the data is returned
+    unless drop_last is set.
+    """
+
+    def __init__(self, fname, table="train", key="inx", batch_size=32, epochs=1,
+                 shuffle=True, chunk_size=256, buffer_size=2048, workers=4,
+                 decode=None, seed=None, drop_last=False, cache_dir=None):
+        self.fname = fname
+        self.table = identifier(table)
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.shuffle = shuffle
+        self.chunk_size = chunk_size
+        self.buffer_size = max(buffer_size, batch_size)
+        self.workers = workers
+        self.decode = dict(image="gray") if decode is None else decode
+        self.seed = seed
+        self.drop_last = drop_last
+        self.cache_dir = cache_dir
+        db = sqlite3.connect(fname)
+        self.key = key_column(db, self.table, identifier(key))
+        keys = [k for (k,) in db.execute("select {} from {} order by {}".format(
+            self.key, self.table, self.key))]
+        db.close()
+        self.nrows = len(keys)
+        self.ranges = chunk_ranges(keys, chunk_size)
+
+    def __len__(self):
+        return self.nrows
+
+    def epoch_ranges(self, epoch):
+        ranges = list(self.ranges)
+        if self.shuffle:
+            seed = None if self.seed is None else self.seed + epoch
+            random.Random(seed).shuffle(ranges)
+        return ranges
+
+    def cache_path(self):
+        return samplecache.cache_path(self.cache_dir, self.fname, table=self.table,
+                                      key=self.key, decode=self.decode)
+
+    def __iter__(self):
+        cache = None
+        epochs = range(self.epochs)
+        if self.cache_dir is not None:
+            cache = samplecache.open_cache(self.cache_path())
+            if cache is None and self.epochs > 0:
+                writer = samplecache.CacheWriter(self.cache_path(), source=self.fname)
+                try:
+                    for batch in self._db_batches(epochs[:1], writer):
+                        yield batch
+                except:
+                    writer.abort()
+                    raise
+                cache = writer.close()
+                epochs = epochs[1:]
+        if cache is not None:
+            for batch in self._cached_batches(cache, epochs):
+                yield batch
+        else:
+            for batch in self._db_batches(epochs):
+                yield batch
+
+    def _batches(self, indexes, make):
+        for i in range(0, len(indexes), self.batch_size):
+            group = indexes[i:i + self.batch_size]
+            if len(group) == self.batch_size or not self.drop_last:
+                yield make(group)
+
+    def _cached_batches(self, cache, epochs):
+        for epoch in epochs:
+            order = np.arange(len(cache))
+            if self.shuffle:
+                seed = None if self.seed is None else self.seed + epoch
+                np.random.RandomState(seed).shuffle(order)
+            for batch in self._batches(order, cache.batch):
+                yield batch
+
+    def _db_batches(self, epochs, writer=None):
+        read = ChunkReader(self.fname, self.table, self.key, self.decode)
+        pool = None
+        if self.workers > 0:
+            pool = multiprocessing.Pool(self.workers)
+            imap = pool.imap
+        else:
+            imap = lambda f, xs: (f(x) for x in xs)
+        rng = random.Random(self.seed)
+        buffer = []
+        try:
+            for epoch in epochs:
+                for samples in imap(read, self.epoch_ranges(epoch)):
+                    if writer is not None:
+                        for sample in samples:
+                            writer.add(sample)
+                    buffer.extend(samples)
+                    if len(buffer) >= self.buffer_size:
+                        if self.shuffle:
+                            rng.shuffle(buffer)
+                        while len(buffer) >= self.batch_size and len(buffer) > self.buffer_size // 2:
+                            yield collate(buffer[-self.batch_size:])
+                            del buffer[-self.batch_size:]
+            if self.shuffle:
+                rng.shuffle(buffer)
+            for batch in self._batches(buffer, collate):
+                yield batch
+        finally:
+            if pool is not None:
+                pool.terminate()
+            else:
+                close_connections()
@@ -0,0 +1,71 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""A minimal runner for models exported with `export.export_model`.
+
+This module only imports torch and NumPy. Importing it as
+`dltrainers.runner` runs the package `__init__`, which loads the whole
+training stack; the `run-model` script loads this file by itself:
+
+    run-model model.pt inputs.npy outputs.npy
+"""
+
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import torch
+
+class Runner(object):
+    """Loads an exported TorchScript model and runs batches of arrays.
+
+    Inputs and outputs are transposed according to the metadata written
+    at export time, so callers pass arrays in the same order as to the
+    trainer (e.g., BHWD images).
+    """
+
+    def __init__(self, path, use_cuda=False):
+        location = "cuda" if use_cuda else "cpu"
+        self.module = torch.jit.load(path, map_location=location)
+        self.module.eval()
+        self.use_cuda = use_cuda
+        self.meta = {}
+        if os.path.exists(path + ".json"):
+            with open(path + ".json") as stream:
+                self.meta = json.load(stream)
+
+    def __call__(self, batch):
+        """Run a batch (an ndarray) and return the outputs as an ndarray."""
+        x = torch.from_numpy(np.asarray(batch, "f"))
+        if self.meta.get("input_transpose"):
+            x = x.permute(*self.meta["input_transpose"])
+        if self.use_cuda:
+            x = x.cuda()
+        with torch.no_grad():
+            y = self.module(x.contiguous())
+        if self.meta.get("output_transpose"):
+            y = y.permute(*self.meta["output_transpose"])
+        return y.contiguous().cpu().numpy()
+
+    def run(self, inputs, batch_size=64):
+        """Yield the outputs for an array of inputs, batch by batch."""
+        for i in range(0, len(inputs), batch_size):
+            yield self(inputs[i:i + batch_size])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run an exported model on a .npy file.")
+    parser.add_argument("model")
+    parser.add_argument("inputs")
+    parser.add_argument("outputs")
+    parser.add_argument("--batchsize", type=int, default=64)
+    parser.add_argument("--cuda", action="store_true")
+    args = parser.parse_args(argv)
+    runner = Runner(args.model, use_cuda=args.cuda)
+    inputs = np.load(args.inputs, mmap_mode="r")
+    outputs = np.concatenate(list(runner.run(inputs, args.batchsize)))
+    np.save(args.outputs, outputs)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
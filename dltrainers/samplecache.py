@@ -0,0 +1,198 @@
+# Copyright (c) 2017 NVIDIA CORPORATION. All rights reserved.
+# See the LICENSE file for licensing terms (BSD-style).
+
+"""A memory-mapped cache of decoded samples.
+
+Decoded samples (dicts of fixed-shape, fixed-dtype arrays and numbers)
+are written to `.npy` shards, one file per field and shard, plus an
+`index.json` that is written last. A cache lives in a directory named
+by a hash of the source file (path, size and modification time), the
+decode parameters, and the cache format version. Any change to these
+invalidates it. Readers map the shards read-only, so several worker
+processes share the same pages of the OS page cache.
+
+Samples that cannot be cached (non-numeric fields, or fields whose
+shape varies) make a `CacheWriter` give up: it drops the partial
+cache, and `close` returns None, so readers keep reading the source.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+FORMAT_VERSION = 1
+
+def source_stat(source):
+    """The size and modification time of source, as stored in index.json."""
+    stat = os.stat(source)
+    return dict(size=stat.st_size, mtime=stat.st_mtime)
+
+def cache_key(source, **params):
+    """A key identifying the decoded contents of source under params."""
+    stat = source_stat(source)
+    description = dict(source=os.path.abspath(source), size=stat["size"],
+                       mtime=stat["mtime"], params=params, version=FORMAT_VERSION)
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:20]
+
+def cache_path(cache_dir, source, **params):
+    return os.path.join(cache_dir, cache_key(source, **params))
+
+class ShardCache(object):
+    """Random access to a complete cache; shards are mapped on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as stream:
+            self.index = json.load(stream)
+        assert self.index["version"] == FORMAT_VERSION, self.index["version"]
+        self.shard_size = self.index["shard_size"]
+        self.nsamples = self.index["nsamples"]
+        self.fields = self.index["fields"]
+        self.maps = {}
+
+    def __len__(self):
+        return self.nsamples
+
+    def shard(self, name, i):
+        key = (name, i)
+        array = self.maps.get(key)
+        if array is None:
+            fname = os.path.join(self.path, "{}-{:06d}.npy".format(name, i))
+            array = self.maps[key] = np.load(fname, mmap_mode="r")
+        return array
+
+    def __getitem__(self, i):
+        shard, offset = divmod(i, self.shard_size)
+        return dict((name, self.shard(name, shard)[offset]) for name in self.fields)
+
+    def batch(self, indexes):
+        """Gather the samples at indexes into a dict of arrays."""
+        indexes = np.asarray(indexes, "int64")
+        shards, offsets = np.divmod(indexes, self.shard_size)
+        result = {}
+        for name, info in self.fields.items():
+            out = np.empty([len(indexes)] + info["shape"], info["dtype"])
+            for shard in np.unique(shards):
+                mask = shards == shard
+                out[mask] = self.shard(name, int(shard))[offsets[mask]]
+            result[name] = out
+        return result
+
+def open_cache(path):
+    """Open the cache at path, or return None if it is missing or incomplete."""
+    if not os.path.exists(os.path.join(path, "index.json")):
+        return None
+    return ShardCache(path)
+
+class CacheWriter(object):
+    """Writes samples to a new cache at path.
+
+    The shards go to a temporary directory that is renamed when `close`
+    is called, so readers only ever see complete caches. Caches of an
+    older version of the same source (with another size or mtime) are
+    removed then; caches of the same version with other decode
+    parameters are kept.
+    """
+
+    def __init__(self, path, source=None, shard_size=4096):
+        self.path = path
+        self.source = None if source is None else os.path.abspath(source)
+        self.stat = None if source is None else source_stat(source)
+        self.shard_size = shard_size
+        self.tmp = "{}.tmp-{}".format(path, os.getpid())
+        if os.path.exists(self.tmp):
+            shutil.rmtree(self.tmp)
+        os.makedirs(self.tmp)
+        self.fields = None
+        self.buffers = None
+        self.fill = 0
+        self.nshards = 0
+        self.nsamples = 0
+        self.failed = None
+
+    def _start(self, sample):
+        self.fields = {}
+        for name, value in sample.items():
+            value = np.asarray(value)
+            if value.dtype.kind not in "biuf":
+                return self._fail("{}: only numeric fields can be cached".format(name))
+            self.fields[name] = dict(dtype=value.dtype.str, shape=list(value.shape))
+        self.buffers = dict((name, np.empty([self.shard_size] + info["shape"], info["dtype"]))
+                            for name, info in self.fields.items())
+        return True
+
+    def _fail(self, reason):
+        self.failed = reason
+        self.buffers = None
+        self.abort()
+        return False
+
+    def add(self, sample):
+        """Add a sample; returns False if the cache was given up (see `failed`)."""
+        if self.failed is not None:
+            return False
+        if self.fields is None and not self._start(sample):
+            return False
+        for name, info in self.fields.items():
+            value = np.asarray(sample.get(name))
+            if list(value.shape) != info["shape"] or value.dtype.kind not in "biuf":
+                return self._fail("{}: samples must have a fixed shape to be cached "
+                                  "({} vs {})".format(name, value.shape, info["shape"]))
+            self.buffers[name][self.fill] = value
+        self.fill += 1
+        self.nsamples += 1
+        if self.fill == self.shard_size:
+            self._flush()
+        return True
+
+    def _flush(self):
+        if self.fill == 0:
+            return
+        for name, buffer in self.buffers.items():
+            fname = os.path.join(self.tmp, "{}-{:06d}.npy".format(name, self.nshards))
+            np.save(fname, buffer[:self.fill])
+        self.nshards += 1
+        self.fill = 0
+
+    def close(self):
+        """Finish the cache and return it as a ShardCache (None if it failed)."""
+        if self.failed is not None:
+            return None
+        self._flush()
+        index = dict(version=FORMAT_VERSION, source=self.source, stat=self.stat,
+                     shard_size=self.shard_size,
+                     nsamples=self.nsamples, nshards=self.nshards, fields=self.fields or {})
+        with open(os.path.join(self.tmp, "index.json"), "w") as stream:
+            json.dump(index, stream)
+        try:
+            os.rename(self.tmp, self.path)
+        except OSError:
+            # another process finished the same cache first
+            shutil.rmtree(self.tmp, ignore_errors=True)
+        self.remove_stale()
+        return ShardCache(self.path)
+
+    def abort(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def remove_stale(self):
+        """Remove the caches of the source that no longer match its size and mtime."""
+        if self.source is None or not os.path.exists(self.source):
+            return
+        current = source_stat(self.source)
+        parent = os.path.dirname(self.path) or "."
+        for index in glob.glob(os.path.join(parent, "*", "index.json")):
+            other = os.path.dirname(index)
+            if os.path.abspath(other) == os.path.abspath(self.path):
+                continue
+            try:
+                with open(index) as stream:
+                    info = json.load(stream)
+            except (IOError, OSError, ValueError):
+                continue
+            if info.get("source") == self.source and info.get("stat") != current:
+                shutil.rmtree(other, ignore_errors=True)
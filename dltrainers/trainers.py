@@ -4,8 +4,12 @@
 """A set of "trainers", classes that wrap around Torch models
 and provide methods for training and evaluation."""
 
+import copy
 import time
+import types
 import platform
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import torch
 from torch import autograd, nn, optim
@@ -13,12 +17,26 @@ from torch.autograd import Variable, Function
 import torch.nn.functional as F
 from scipy import ndimage
 import helpers as dlh
+import buckets
+import checkpoints
+import ctc
+import prefetch
+import logs
+import flex
+import layers
+import parallel
+import profiling
 
 def add_log(log, logname, **kw):
+    if isinstance(log, logs.TrainingLog):
+        log.add(logname, **kw)
+        return
     entry = dict(kw, __log__=logname, __at__=time.time(), __node__=platform.node())
     log.append(entry)
 
 def get_log(log, logname, **kw):
+    if isinstance(log, logs.TrainingLog):
+        return log.records(logname)
     records = [x for x in log if x.get("__log__")==logname]
     return records
 
@@ -38,6 +56,115 @@ class Weighted(Function):
         return grad_input
 
 
+class DeferredValue(object):
+    """A scalar that stays on the device until it is needed.
+
+    `float(v)` or `v.get()` reads the value back (once).
+    """
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.value = None
+    def get(self):
+        if self.value is None:
+            self.value = dlh.scalar(self.tensor)
+            self.tensor = None
+        return self.value
+    def __float__(self):
+        return self.get()
+    def __repr__(self):
+        if self.value is None:
+            return "DeferredValue(pending)"
+        return "DeferredValue({})".format(self.value)
+
+class LazyOutputs(object):
+    """A handle to a batch of outputs that is converted only on access.
+
+    `get()` returns the converted outputs; indexing, `len`, and
+    attribute access are forwarded to them, and the handle can be
+    passed to NumPy functions.
+    """
+    def __init__(self, convert, output):
+        self._convert = convert
+        self._output = output
+        self._value = None
+    def get(self):
+        if self._convert is not None:
+            self._value = self._convert(self._output)
+            self._convert = self._output = None
+        return self._value
+    def __array__(self, *args):
+        return np.asarray(dlh.asnd(self.get()), *args)
+    def __getitem__(self, index):
+        return self.get()[index]
+    def __len__(self):
+        return len(self.get())
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+class BatchSizer(object):
+    """Picks a batch size by doubling it while the throughput improves.
+
+    With a given size, that size is used throughout. Otherwise, the
+    size starts at min_size and doubles as long as each doubling
+    raises the samples per second by more than min_gain (relative);
+    then it settles on the best size seen. At each size, the first
+    `warmup` batches (which pay for allocating buffers of the new
+    shape) are not timed, and the throughput is averaged over the
+    next `trials` batches.
+    """
+
+    def __init__(self, size=None, max_size=256, min_size=8, min_gain=0.05,
+                 warmup=1, trials=2):
+        self.fixed = size is not None
+        self.size = size or min(min_size, max_size)
+        self.max_size = max_size
+        self.min_gain = min_gain
+        self.warmup = warmup
+        self.trials = max(1, trials)
+        self.best = None
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.samples = 0
+        self.elapsed = 0.0
+
+    def update(self, n, elapsed):
+        """Record that n samples took elapsed seconds at the current size."""
+        if self.fixed or n < self.size or elapsed <= 0:
+            return
+        self.batches += 1
+        if self.batches <= self.warmup:
+            return
+        self.samples += n
+        self.elapsed += elapsed
+        if self.batches < self.warmup + self.trials:
+            return
+        rate = self.samples / self.elapsed
+        self.reset()
+        if self.best is not None and rate <= self.best * (1.0 + self.min_gain):
+            self.size //= 2
+            self.fixed = True
+        elif self.size * 2 > self.max_size:
+            self.fixed = True
+        else:
+            self.best = rate
+            self.size *= 2
+
+def regroup(samples, sizer, batched=False):
+    """Yield lists of sizer.size samples (the last one may be shorter)."""
+    group = []
+    for item in samples:
+        for sample in (item if batched else [item]):
+            group.append(sample)
+            if len(group) >= sizer.size:
+                yield group
+                group = []
+    if len(group) > 0:
+        yield group
+
 class BasicTrainer(object):
     """Trainers take care of bookkeeping for training models.
 
@@ -48,22 +175,50 @@ class BasicTrainer(object):
     Trainers are just a temporary tool that's wrapped around a model
     for training purposes, so you can create, use, and discard them
     as convenient.
+
+    If `input_shape` (in the order the model expects) is given, any
+    Flex layers are created before the optimizer is set up; see
+    `flex.flex_build`.
+
+    The log (`self.log`) keeps every record. For very long runs,
+    replace it with a `logs.TrainingLog` with a capacity and a spill
+    file.
     """
 
     def __init__(self, model, use_cuda=True,
                  fields = ("input", "output"),
                  input_axes = None,
-                 output_axes = None):
+                 output_axes = None,
+                 input_shape = None):
         self.use_cuda = use_cuda
+        self.copies = dlh.CopyCounter()
+        self.buffers = dlh.BufferPool(use_cuda=use_cuda, counter=self.copies)
+        self.volatile = False
+        if input_shape is not None:
+            flex.flex_build(model, input_shape)
         self.model = self._cuda(model)
         self.init_loss()
         self.input_name, self.output_name = fields
         self.no_display = False
+        self.ntrain = 0
         self.current_lr = None
+        self.optimizer = None
+        self.schedule = None
         self.set_lr(1e-3)
         self.weighted = Weighted()
-        self.ntrain = 0
-        self.log = []
+        self.log = logs.TrainingLog()
+        self.prefetch_options = None
+        self.profiler = None
+        self.validation = None
+        self.set_microbatch()
+        self.half_model = None
+        self.scaler = None
+        self.parallel = None
+        self.checkpointer = None
+        self.checkpoint_every = None
+        self.sync_every = 1
+        self.lazy_outputs = False
+        self.pending_losses = []
 
     def _cuda(self, x):
         """Convert object to CUDA if use_cuda==True."""
@@ -74,46 +229,142 @@ class BasicTrainer(object):
 
     def set_training(self, mode=True):
         """Set training or prediction mode."""
-        if mode:
-            if not self.model.training:
-                self.model.train()
-            self.cuinput = autograd.Variable(
-                torch.randn(1, 1, 100, 100).cuda())
-            self.cutarget = autograd.Variable(torch.randn(1, 11).cuda())
-        else:
-            if self.model.training:
-                self.model.eval()
-            self.cuinput = autograd.Variable(torch.randn(1, 1, 100, 100).cuda(),
-                                             volatile=True)
-            self.cutarget = autograd.Variable(torch.randn(1, 11).cuda(),
-                                              volatile=True)
+        for model in (self.model, self.half_model):
+            if model is None:
+                continue
+            if mode:
+                if not model.training:
+                    model.train()
+            else:
+                if model.training:
+                    model.eval()
+        self.volatile = not mode
+
+    def compute_model(self):
+        """The model that runs forward and backward (see `set_precision`)."""
+        return self.model if self.half_model is None else self.half_model
+
+    def float_type(self):
+        """The CPU type name of the model's parameters (float if it has none)."""
+        for p in self.model.parameters():
+            return p.data.type().replace(".cuda", "")
+        return "torch.FloatTensor"
+
+    def _variable(self, name, data, transpose_on_convert=None, dtype=None):
+        """Copies data into the pooled buffer `name` and wraps it.
+
+        The buffer has the type of the model's parameters unless dtype
+        is given, so integer data is converted in the copy. Copies are
+        counted in `self.copies` (see `helpers.CopyCounter`).
+        """
+        dtype = dtype or self.float_type()
+        buffer = self.buffers.assign(name, data, transpose_on_convert, dtype=dtype)
+        return autograd.Variable(buffer, volatile=self.volatile)
 
     def set_lr(self, lr, momentum=0.9, weight_decay=0.0):
-        """Set the optimizer to SGD with the given parameters."""
-        self.current_lr = lr
-        self.optimizer = optim.SGD(self.model.parameters(),
-                                   lr=lr,
-                                   momentum=momentum,
-                                   weight_decay=weight_decay)
+        """Set the SGD learning rate, momentum and weight decay.
+
+        lr is a number or a schedule: a function of `ntrain` (e.g.,
+        `helpers.CosineSchedule`) or a `helpers.LearningRateSchedule`
+        string, applied before each optimizer step. The optimizer's
+        parameter groups are updated in place, so momentum is kept;
+        parameters created since the last call (e.g., by Flex layers
+        on the first forward pass) are added to the optimizer.
+        """
+        if callable(lr) or isinstance(lr, str):
+            self.schedule = dlh.make_schedule(lr)
+            lr = self.schedule(self.ntrain)
+        else:
+            self.schedule = None
+        if self.optimizer is None:
+            self.optimizer = optim.SGD(self.model.parameters(),
+                                       lr=lr,
+                                       momentum=momentum,
+                                       weight_decay=weight_decay)
+        else:
+            for group in self.optimizer.param_groups:
+                group.update(momentum=momentum, weight_decay=weight_decay)
+            self.add_new_parameters()
+        self.apply_lr(lr)
+
+    def add_new_parameters(self):
+        """Add model parameters that the optimizer does not know yet."""
+        known = set(id(p) for group in self.optimizer.param_groups for p in group["params"])
+        new = [p for p in self.model.parameters() if id(p) not in known]
+        if len(new) == 0:
+            return
+        settings = dict((k, v) for k, v in self.optimizer.param_groups[0].items()
+                        if k != "params")
+        if hasattr(self.optimizer, "add_param_group"):
+            self.optimizer.add_param_group(dict(settings, params=new))
+        else:
+            state = self.optimizer.state
+            self.optimizer = optim.SGD(self.model.parameters(), **settings)
+            self.optimizer.state.update(state)
+
+    def apply_lr(self, lr):
+        """Set the learning rate of all parameter groups in place."""
+        if lr != self.current_lr:
+            for group in self.optimizer.param_groups:
+                group["lr"] = lr
+            self.current_lr = lr
+
+    def set_sync(self, every=1, lazy_outputs=False):
+        """Set how often losses are read back from the device.
+
+        With every > 1, `train_batch` returns `DeferredValue` losses
+        and logs them in groups of `every` with a single transfer; use
+        `sync_losses` to read them back earlier. With lazy_outputs,
+        `train_batch` returns a `LazyOutputs` handle instead of
+        converting the outputs.
+        """
+        self.sync_losses()
+        self.sync_every = every
+        self.lazy_outputs = lazy_outputs
+
+    def sync_losses(self):
+        """Read back and log all pending losses."""
+        pending = self.pending_losses
+        if len(pending) == 0:
+            return
+        self.pending_losses = []
+        # losses already read with float(loss) or loss.get() are not read again
+        unread = [loss for _, loss, _ in pending if loss.value is None]
+        if len(unread) > 0:
+            values = torch.cat([loss.tensor.view(-1) for loss in unread])
+            values = values.cpu()
+            for i, loss in enumerate(unread):
+                loss.value = float(values[i])
+                loss.tensor = None
+        for logname, loss, entry in pending:
+            add_log(self.log, logname, loss=loss.value, **entry)
 
     def get_outputs(self):
         """Performs any necessary transformations on the output tensor.
         """
-        return dlh.novar(self.cuoutput).cpu()
+        return self.convert_outputs(self.cuoutput)
+
+    def convert_outputs(self, output):
+        """Converts a batch of model outputs for returning to the caller."""
+        output = dlh.novar(output)
+        if output.is_cuda:
+            output = output.cpu()
+            dlh.count_copy(self.copies, "d2h", output)
+        return output
 
     def set_inputs(self, batch):
         """Sets the cuinput variable from the input data.
         """
-        assert isinstance(batch, torch.Tensor)
-        dlh.assign(self.cuinput, batch)
+        assert isinstance(batch, (torch.Tensor, np.ndarray))
+        self.cuinput = self._variable("input", batch)
 
     def set_targets(self, targets, weights=None):
         """Sets the cutarget variable from the given tensor.
         """
-        dlh.assign(self.cutarget, targets, False)
-        assert self.cuoutput.size() == self.cutargets.size()
+        self.cutarget = self._variable("target", targets)
+        assert self.cuoutput.size() == self.cutarget.size()
         if weights is not None:
-            dlh.assign(self.cuweights, weights, False)
+            self.cuweights = self._variable("weights", weights)
             assert self.cuoutput.size() == self.cuweights.size()
         else:
             self.cuweights = None
@@ -127,43 +378,402 @@ class BasicTrainer(object):
 
     def forward(self):
         try:
-            self.cuoutput = self.model(self.cuinput)
+            if self.half_model is None:
+                self.cuoutput = self.model(self.cuinput)
+            else:
+                cuinput = self.cuinput.half()
+                dlh.count_copy(self.copies, "device", cuinput.data)
+                self.cuoutput = self.half_model(cuinput).float()
         except RuntimeError, err:
             print "runtime error in forward step:"
             print "input", self.cuinput.size()
             raise err
 
+    def set_precision(self, dtype=None, loss_scale="dynamic"):
+        """Train in float16 on the GPU (dtype None: the model's own type).
+
+        A float16 copy of the model runs forward and backward, while
+        `self.model` keeps float32 master weights for the optimizer,
+        checkpoints and export; after each step, the master weights are
+        copied into the float16 model. Outputs are converted to float32,
+        so losses (e.g., CTC alignment and BCE) are computed in float32.
+        loss_scale is None, a fixed scale, or "dynamic" (see
+        `helpers.LossScaler`); steps whose gradients overflow are
+        skipped. Flex layers must be built first, and data-parallel
+        training is not supported.
+        """
+        self.half_model = None
+        self.scaler = None
+        if dtype is None:
+            return
+        if dtype != "float16":
+            raise ValueError("{}: only float16 is supported".format(dtype))
+        assert self.use_cuda, "float16 training requires CUDA"
+        assert self.parallel is None, "float16 is not supported with data-parallel training"
+        assert len(flex.flex_unbuilt(self.model)) == 0, \
+            "build the Flex layers first (input_shape or flex.flex_build)"
+        self.half_model = copy.deepcopy(self.model).half()
+        self.half_model.train(self.model.training)
+        if loss_scale == "dynamic":
+            self.scaler = dlh.LossScaler()
+        elif loss_scale is not None:
+            self.scaler = dlh.LossScaler(scale=float(loss_scale), dynamic=False)
+
+    def set_profiling(self, enabled=True, layers=False, timer=None, every=1):
+        """Turn timing of the training stages on or off.
+
+        When enabled, train_batch times set_inputs, forward,
+        compute_loss, backward, step and outputs (and, with layers=True,
+        the forward and backward passes of each submodule), and logs
+        the times of a step to the "profile" log at most once per
+        `every` training samples. Use `profiler.summary()` for
+        percentiles. `timer` defaults to `time.time`; use
+        `profiling.synchronized_timer` for CUDA.
+        """
+        if self.profiler is not None:
+            self.profiler.detach()
+        if not enabled:
+            self.profiler = None
+            return
+        self.profiler = profiling.Profiler(timer=timer or time.time)
+        if layers:
+            self.profiler.attach(self.compute_model())
+        self.profile_every = every
+        self.profile_next = 0
+
+    def stage(self, name):
+        """Returns a context manager timing the named stage, if profiling."""
+        if self.profiler is None:
+            return profiling.null_stage
+        return self.profiler.stage(name)
+
+    def set_microbatch(self, size=None, accumulate=1):
+        """Set up micro-batching and gradient accumulation.
+
+        With a size, each batch passed to `train_batch` is processed in
+        chunks of at most that many samples, accumulating gradients.
+        With accumulate > 1, the optimizer only steps every `accumulate`
+        calls to `train_batch`. Losses are scaled so that the gradient
+        matches that of a single large batch.
+        """
+        self.microbatch = size
+        self.accumulate = accumulate
+        self.accumulated = 0
+
+    def set_data_parallel(self, nprocs=None, threads=None):
+        """Train on nprocs local CPU processes (None or 1 turns this off).
+
+        Each process holds a replica of the model and handles a shard
+        of every training batch; gradients are summed over a gloo group
+        on localhost (see `parallel.DataParallel`). Losses, outputs,
+        `ntrain` and the log are kept in this process as before.
+        Evaluation and prediction run in this process only, and shards
+        are not further split into micro-batches. Flex layers must be
+        built first. Per-sample batch info, such as the lengths of an
+        Image2SeqTrainer, is split along with the batch (see
+        `shard_info`).
+        """
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
+        if nprocs is not None and nprocs > 1:
+            assert self.half_model is None, "data-parallel training does not support float16"
+            self.parallel = parallel.DataParallel(self, nprocs, threads=threads)
+
+    def trainer_state(self):
+        """A snapshot of the trainer state: model, optimizer, ntrain, lr and log.
+
+        Tensors are copied to the CPU, so the snapshot can be written
+        while training continues.
+        """
+        self.sync_losses()
+        if isinstance(self.log, logs.TrainingLog):
+            log = dict(capacity=self.log.capacity, records=self.log.snapshot())
+        else:
+            log = [dict(entry) for entry in self.log]
+        return dict(model=checkpoints.snapshot(self.model.state_dict()),
+                    optimizer=checkpoints.snapshot(self.optimizer.state_dict()),
+                    ntrain=self.ntrain,
+                    current_lr=self.current_lr,
+                    log=log)
+
+    def load_trainer_state(self, state):
+        """Restore a state from trainer_state; Flex layers must be built."""
+        self.model.load_state_dict(state["model"])
+        optimizer_state = dict(state["optimizer"])
+        optimizer_state["state"] = dict(
+            (k, dict((name, self._cuda(v) if torch.is_tensor(v) else v)
+                     for name, v in param_state.items()))
+            for k, param_state in optimizer_state["state"].items())
+        self.optimizer.load_state_dict(optimizer_state)
+        self.current_lr = state["current_lr"]
+        self.ntrain = state["ntrain"]
+        log = state["log"]
+        if isinstance(log, dict):
+            self.log = logs.TrainingLog.from_snapshot(log["records"], capacity=log["capacity"])
+        else:
+            self.log = log
+        self.accumulated = 0
+        if self.half_model is not None:
+            self.half_model.load_state_dict(self.model.state_dict())
+
+    def set_checkpointing(self, directory=None, every=None, keep=3, keep_every=None):
+        """Write checkpoints to directory (None turns checkpointing off).
+
+        With every, `train_batch` checkpoints every that many training
+        samples. Checkpoints are written in the background; only the
+        newest `keep` (plus one per keep_every samples) are kept.
+        """
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        self.checkpointer = None
+        self.checkpoint_every = every
+        if directory is not None:
+            self.checkpointer = checkpoints.Checkpointer(directory, keep=keep,
+                                                         keep_every=keep_every)
+            self.checkpoint_next = self.ntrain + (every or 0)
+
+    def checkpoint(self, wait=False):
+        """Write a checkpoint of the current state; returns its path."""
+        assert self.checkpointer is not None, "call set_checkpointing first"
+        with self.stage("checkpoint"):
+            return self.checkpointer.save(self.trainer_state(), self.ntrain, wait=wait)
+
+    def restore(self, path=None, mmap=True):
+        """Restore a checkpoint (by default, the latest); returns its path or None."""
+        if path is None:
+            assert self.checkpointer is not None, "call set_checkpointing first"
+            self.checkpointer.wait()
+            path = self.checkpointer.latest()
+            if path is None:
+                return None
+        self.load_trainer_state(checkpoints.load_state(path, mmap=mmap))
+        if self.checkpoint_every:
+            self.checkpoint_next = self.ntrain + self.checkpoint_every
+        return path
+
+    def loss_is_mean(self):
+        """Whether the criterion averages over the batch (vs. summing)."""
+        reduction = getattr(self.criterion, "reduction", None)
+        if reduction is not None:
+            return reduction in ("mean", "elementwise_mean")
+        return getattr(self.criterion, "size_average", True)
+
+    def batch_loss(self, inputs, targets, weights=None):
+        """Runs the forward step on a batch and returns the loss."""
+        with self.stage("set_inputs"):
+            self.set_inputs(inputs)
+        with self.stage("forward"):
+            self.forward()
+        if weights is not None:
+            self.cuweights = self._variable("weights", weights)
+            self.cuoutput = self.weighted(self.cuoutput, self.cuweights)
+        with self.stage("compute_loss"):
+            return self.compute_loss(targets, weights=weights)
+
+    def backward(self, culoss):
+        """Runs the backward step for the given loss."""
+        with self.stage("backward"):
+            if self.profiler is not None:
+                self.profiler.begin_backward()
+            if self.scaler is not None:
+                culoss = culoss * self.scaler.scale
+            culoss.backward()
+
+    def zero_grad(self):
+        """Clear the gradients of the model (and of its float16 copy)."""
+        self.optimizer.zero_grad()
+        if self.half_model is not None:
+            for p in self.half_model.parameters():
+                if p.grad is not None:
+                    p.grad.data.zero_()
+
+    def step(self):
+        """Run the optimizer step.
+
+        With float16 training, the gradients of the float16 model are
+        copied to the master weights and unscaled first; the step is
+        skipped if they overflowed. The running statistics of the
+        float16 model (e.g., of batch norm) are copied back, too.
+        """
+        if self.half_model is None:
+            self.optimizer.step()
+            return
+        masters = list(self.model.parameters())
+        halfs = list(self.half_model.parameters())
+        for master, half in zip(masters, halfs):
+            if half.grad is None:
+                continue
+            if master.grad is None:
+                master.grad = Variable(master.data.new(*master.size()).zero_())
+            master.grad.data.copy_(half.grad.data)
+        if self.scaler is not None:
+            finite = self.scaler.unscale(masters)
+            self.scaler.update(finite)
+            if not finite:
+                return
+        self.optimizer.step()
+        names = set(name for name, _ in self.model.named_parameters())
+        state = self.model.state_dict()
+        for name, value in self.half_model.state_dict().items():
+            if name not in names:
+                state[name].copy_(value)
+        for master, half in zip(masters, halfs):
+            half.data.copy_(master.data)
+
+    def set_validation(self, level=None):
+        """Set the level of runtime checks while this trainer runs.
+
+        See `helpers.set_validation` for the levels; None uses the
+        global level.
+        """
+        self.validation = level
+
     def train_batch(self, inputs, targets, weights=None, update=True, logname="train"):
+        dlh.begin_validation_step(self.validation)
         if update:
             self.set_training(True)
-            self.optimizer.zero_grad()
+            if self.schedule is not None:
+                self.apply_lr(self.schedule(self.ntrain))
+            if self.accumulated == 0 and self.parallel is None:
+                self.zero_grad()
         else:
             self.set_training(False)
-        self.set_inputs(inputs)
-        self.forward()
-        if weights is not None:
-            self.cuweights = autograd.Variable(torch.randn(1, 1).cuda())
-            dlh.assign(self.cuweights, weights, False)
-            self.cuoutput = self.weighted(self.cuoutput, self.cuweights)
-        culoss = self.compute_loss(targets, weights=weights)
+        n = dlh.size(inputs, 0)
+        chunk = self.microbatch or n
+        if self.parallel is not None and update:
+            culoss, output = self.parallel.train_batch(
+                self, inputs, targets, weights, zero=(self.accumulated == 0),
+                step=(self.accumulated + 1 >= self.accumulate))
+        elif chunk >= n and self.accumulate <= 1:
+            culoss = self.batch_loss(inputs, targets, weights)
+            if update:
+                self.backward(culoss)
+            culoss = dlh.novar(culoss)
+            output = self.cuoutput
+        else:
+            mean = self.loss_is_mean()
+            culosses, outputs = [], []
+            info = self.shard_info(0, n)
+            try:
+                for lo in range(0, n, chunk):
+                    hi = min(n, lo + chunk)
+                    self.set_batch_info(self.shard_info(lo, hi))
+                    part = self.batch_loss(inputs[lo:hi], targets[lo:hi],
+                                           None if weights is None else weights[lo:hi])
+                    scale = (hi - lo) * 1.0 / n if mean else 1.0
+                    if update:
+                        self.backward(part * (scale / self.accumulate if mean else scale))
+                    culosses.append(dlh.novar(part) * scale)
+                    outputs.append(dlh.novar(self.cuoutput))
+            finally:
+                self.set_batch_info(info)
+            culoss = culosses[0]
+            for part in culosses[1:]:
+                culoss = culoss + part
+            output = outputs[0] if len(outputs) == 1 else torch.cat(outputs, 0)
         if update:
-            culoss.backward()
-            self.optimizer.step()
-        ploss = dlh.novar(culoss)[0]
-        self.ntrain += dlh.size(inputs, 0)
-        add_log(self.log, logname, loss=ploss, ntrain=self.ntrain, lr=self.current_lr)
-        return self.get_outputs(), ploss
+            self.accumulated += 1
+            if self.accumulated >= self.accumulate:
+                with self.stage("step"):
+                    self.step()
+                self.accumulated = 0
+        self.ntrain += n
+        if self.sync_every <= 1:
+            ploss = dlh.scalar(culoss)
+            add_log(self.log, logname, loss=ploss, ntrain=self.ntrain, lr=self.current_lr)
+        else:
+            ploss = DeferredValue(culoss)
+            entry = dict(ntrain=self.ntrain, lr=self.current_lr, __at__=time.time())
+            self.pending_losses.append((logname, ploss, entry))
+            if len(self.pending_losses) >= self.sync_every:
+                self.sync_losses()
+        if update and self.checkpoint_every and self.ntrain >= self.checkpoint_next:
+            self.checkpoint()
+            self.checkpoint_next = self.ntrain + self.checkpoint_every
+        with self.stage("outputs"):
+            if self.lazy_outputs:
+                result = LazyOutputs(self.convert_outputs, output)
+            else:
+                result = self.convert_outputs(output)
+        if self.profiler is not None:
+            times = self.profiler.end_step()
+            if self.ntrain >= self.profile_next:
+                add_log(self.log, "profile", ntrain=self.ntrain, **times)
+                self.profile_next = self.ntrain + self.profile_every
+        return result, ploss
 
     def eval_batch(self, inputs, targets):
         return self.train_batch(inputs, targets, update=False, logname="eval")
 
     def predict_batch(self, inputs):
+        dlh.begin_validation_step(self.validation)
         self.set_training(False)
-        self.set_inputs(inputs)
-        self.forward()
+        with dlh.no_grad():
+            self.set_inputs(inputs)
+            self.forward()
         return self.get_outputs()
 
-    def loss_curve(self, logname):
+    def collate(self, samples):
+        """Combine single samples into a batch; returns (batch, info).
+
+        info is passed to `set_batch_info` before the batch is run and
+        to `split_outputs` afterwards. The batch is an array, so that
+        `set_inputs` transposes it like any other input batch.
+        """
+        batch = np.array([dlh.asnd(x) for x in samples])
+        dlh.count_copy(self.copies, "host", batch)
+        return batch, {}
+
+    def split_outputs(self, outputs, info):
+        """Split a converted batch of outputs into a list of per-sample outputs."""
+        return list(outputs)
+
+    def _predicted(self, output, info):
+        return self.split_outputs(dlh.asnd(self.convert_outputs(output)), info)
+
+    def predict_iter(self, samples, batch_size=None, max_batch_size=256, batched=False):
+        """Predict a stream of samples; yields one NumPy output per sample, in order.
+
+        Samples are regrouped into batches of batch_size; if it is None,
+        the batch size is found by doubling it while the throughput
+        improves, up to max_batch_size. With batched=True, each item of
+        samples is a batch of any size. Batches run without gradients
+        in the pooled input buffers, and the outputs of each batch are
+        converted on a background thread while the next one runs.
+        """
+        sizer = BatchSizer(batch_size, max_batch_size)
+        converter = ThreadPool(1)
+        pending = deque()
+        self.set_training(False)
+        try:
+            for group in regroup(samples, sizer, batched):
+                dlh.begin_validation_step(self.validation)
+                start = time.time()
+                batch, info = self.collate(group)
+                self.set_batch_info(info)
+                with dlh.no_grad():
+                    self.set_inputs(batch)
+                    self.forward()
+                if not sizer.fixed:
+                    if self.use_cuda:
+                        torch.cuda.synchronize()
+                    sizer.update(len(group), time.time() - start)
+                pending.append(converter.apply_async(self._predicted, (self.cuoutput, info)))
+                while len(pending) > 1:
+                    for output in pending.popleft().get():
+                        yield output
+            while len(pending) > 0:
+                for output in pending.popleft().get():
+                    yield output
+        finally:
+            converter.close()
+            self.set_batch_info({})
+
+    def loss_curve(self, logname, maxpoints=None):
+        self.sync_losses()
+        if isinstance(self.log, logs.TrainingLog):
+            return self.log.curve(logname, "ntrain", "loss", maxpoints=maxpoints)
         records = get_log(self.log, logname)
         records = [(x["ntrain"], x["loss"]) for x in records]
         records = sorted(records)
@@ -172,16 +782,16 @@ class BasicTrainer(object):
         else:
             return zip(*records)
 
-    def plot_loss(self, every=100, smooth=1e-2, yscale=None):
+    def plot_loss(self, every=100, smooth=1e-2, yscale=None, maxpoints=2000):
         if self.no_display: return
         # we import these locally to avoid dependence on display
         # functions for training
         import matplotlib as mpl
         from matplotlib import pyplot
         from scipy.ndimage import filters
-        x, y = self.loss_curve("train")
+        x, y = self.loss_curve("train", maxpoints=maxpoints)
         pyplot.plot(x, y)
-        x, y = self.loss_curve("test")
+        x, y = self.loss_curve("test", maxpoints=maxpoints)
         pyplot.plot(x, y)
 
     def display_loss(self, *args, **kw):
@@ -193,34 +803,72 @@ class BasicTrainer(object):
         self.input_name = input_name
         self.output_name = output_name
 
+    def set_prefetch(self, depth=4, workers=1, mode="thread"):
+        """Prefetch and convert batches in the background in train_for/eval_for.
+
+        See `prefetch.Prefetcher` for the arguments; depth=0 turns
+        prefetching off.
+        """
+        if depth > 0:
+            self.prefetch_options = dict(depth=depth, workers=workers, mode=mode)
+        else:
+            self.prefetch_options = None
+
+    def _batches(self, source):
+        if isinstance(source, types.FunctionType):
+            source = source()
+        if self.prefetch_options is None:
+            return source
+        return prefetch.Prefetcher(source, (self.input_name, self.output_name),
+                                   pin_memory=self.use_cuda,
+                                   **self.prefetch_options)
+
+    def set_batch_info(self, batch):
+        """Hook for extra fields of the batches passed to train_for/eval_for."""
+        pass
+
+    def shard_info(self, lo, hi):
+        """The batch info (for set_batch_info) of samples lo:hi of the current batch."""
+        return {}
+
     def train_for(self, training, training_size=1e99):
-        if isinstance(training, types.FunctionType):
-            training = training()
+        training = self._batches(training)
         count = 0
         losses = []
-        for batch in training:
-            if count >= training_size: break
-            input_tensor = batch[self.input_name]
-            output_tensor = batch[self.output_name]
-            _, loss = self.train_batch(input_tensor, output_tensor)
-            count += len(input_tensor)
-            losses.append(loss)
-        loss = np.mean(losses)
+        try:
+            for batch in training:
+                if count >= training_size: break
+                input_tensor = batch[self.input_name]
+                output_tensor = batch[self.output_name]
+                self.set_batch_info(batch)
+                _, loss = self.train_batch(input_tensor, output_tensor)
+                count += len(input_tensor)
+                losses.append(loss)
+        finally:
+            if isinstance(training, prefetch.Prefetcher):
+                training.close()
+        self.sync_losses()
+        loss = np.mean([float(l) for l in losses])
         return loss, count
 
     def eval_for(self, testset, testset_size=1e99):
-        if isinstance(testset, types.FunctionType):
-            testset = testset()
+        testset = self._batches(testset)
         count = 0
         losses = []
-        for batch in testset:
-            if count >= testset_size: break
-            input_tensor = batch[self.input_name]
-            output_tensor = batch[self.output_name]
-            _, loss = self.eval_batch(input_tensor, output_tensor)
-            count += len(input_tensor)
-            losses.append(loss)
-        loss = np.mean(losses)
+        try:
+            for batch in testset:
+                if count >= testset_size: break
+                input_tensor = batch[self.input_name]
+                output_tensor = batch[self.output_name]
+                self.set_batch_info(batch)
+                _, loss = self.eval_batch(input_tensor, output_tensor)
+                count += len(input_tensor)
+                losses.append(loss)
+        finally:
+            if isinstance(testset, prefetch.Prefetcher):
+                testset.close()
+        self.sync_losses()
+        loss = np.mean([float(l) for l in losses])
         return loss, count
 
 class ImageClassifierTrainer(BasicTrainer):
@@ -228,20 +876,20 @@ class ImageClassifierTrainer(BasicTrainer):
         BasicTrainer.__init__(self, *args, **kw)
 
     def set_inputs(self, images, depth1=False):
-        dlh.assign(self.cuinput, images, transpose_on_convert=(0, 3, 1, 2))
+        self.cuinput = self._variable("input", images, (0, 3, 1, 2))
 
     def set_targets(self, targets, weights=None):
         assert weights is None, "weights not implemented"
         if dlh.rank(targets) == 1:
-            targets = dlh.as_torch(targets)
+            targets = dlh.as_torch(targets).long()
             targets = targets.unsqueeze(1)
             b, c = dlh.shp(self.cuoutput)
             onehot = torch.zeros(b, c)
             onehot.scatter_(1, targets, 1)
-            dlh.assign(self.cutarget, onehot)
+            self.cutarget = self._variable("target", onehot)
         else:
             assert dlh.shp(targets) == dlh.shp(self.cuoutput)
-            dlh.assign(self.cutarget, targets)
+            self.cutarget = self._variable("target", targets)
 
 
 def zoom_like(batch, target_shape, order=0):
@@ -251,6 +899,73 @@ def zoom_like(batch, target_shape, order=0):
     ndimage.zoom(batch, scales, order=order, output=result)
     return result
 
+def zoom_indexes(n, m):
+    """Source indexes for order 0 zooming of an axis from n to m elements.
+
+    This uses the same coordinate mapping as `scipy.ndimage.zoom`;
+    coordinates that round past the end of the axis are marked with -1
+    (zoom fills them with zeros).
+    """
+    scale = (n - 1) * 1.0 / (m - 1) if m > 1 else 1.0
+    coords = np.arange(m) * scale
+    index = np.floor(coords + 0.5).astype("int64")
+    index[coords > n - 1] = -1
+    return index
+
+class Resampler(object):
+    """Order 0 resampling of tensors to a target shape, on their device.
+
+    The index maps are computed once per (input shape, output shape,
+    device) and kept in an LRU cache of `maxsize` entries. The result
+    is the same as `zoom_like(batch, shape, order=0)`, but keeps the
+    dtype of the input.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+
+    def indexes(self, x, shape):
+        device = x.get_device() if x.is_cuda else "cpu"
+        key = (tuple(x.size()), tuple(shape), device)
+        if key in self.cache:
+            result = self.cache.pop(key)
+        else:
+            result = []
+            for n, m in zip(x.size(), shape):
+                index = zoom_indexes(n, m)
+                if n == m and np.all(index == np.arange(m)):
+                    result.append(None)
+                    continue
+                outside = np.nonzero(index < 0)[0]
+                index = torch.from_numpy(np.maximum(index, 0))
+                outside = torch.from_numpy(outside) if len(outside) > 0 else None
+                if x.is_cuda:
+                    index = index.cuda(device)
+                    outside = outside.cuda(device) if outside is not None else None
+                result.append((index, outside))
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        self.cache[key] = result
+        return result
+
+    def __call__(self, x, shape, out=None):
+        """Resample x to shape, optionally into out."""
+        x = dlh.novar(x)
+        assert x.dim() == len(shape), (x.size(), shape)
+        steps = [(i, maps) for i, maps in enumerate(self.indexes(x, shape))
+                 if maps is not None]
+        if len(steps) == 0:
+            return x if out is None else out.resize_as_(x).copy_(x)
+        for k, (i, (index, outside)) in enumerate(steps):
+            if k < len(steps) - 1 or out is None:
+                x = x.index_select(i, index)
+            else:
+                x = torch.index_select(x, i, index, out=out)
+            if outside is not None:
+                x.index_fill_(i, outside, 0)
+        return x
+
 def pixels_to_batch(x):
     b, d, h, w = x.size()
     return x.permute(0, 2, 3, 1).contiguous().view(b*h*w, d)
@@ -259,6 +974,7 @@ class Image2ImageTrainer(BasicTrainer):
     """Train image to image models."""
     def __init__(self, *args, **kw):
         BasicTrainer.__init__(self, *args, **kw)
+        self.resampler = Resampler()
 
     def compute_loss(self, targets, weights=None):
         self.set_targets(targets, weights=weights)
@@ -266,58 +982,122 @@ class Image2ImageTrainer(BasicTrainer):
                               pixels_to_batch(self.cutarget))
 
     def set_inputs(self, images):
-        dlh.assign(self.cuinput, images, (0, 3, 1, 2))
+        self.cuinput = self._variable("input", images, (0, 3, 1, 2))
 
-    def get_outputs(self):
-        return dlh.as_nda(self.cuoutput, (0, 2, 3, 1))
+    def convert_outputs(self, output):
+        return dlh.as_nda(output, (0, 2, 3, 1), counter=self.copies)
+
+    def _resampled(self, name, data):
+        """Copies BHWD data to the device and resamples it like cuoutput.
+
+        The data is resampled in its own dtype (e.g., uint8 label maps)
+        and then converted to the type of cuoutput.
+        """
+        shape = tuple(self.cuoutput.size())
+        raw = self.buffers.assign(name + "_raw", data, (0, 3, 1, 2))
+        like = dlh.tensor_type(self.cuoutput.data.type())
+        if raw.type() == self.cuoutput.data.type():
+            result = self.resampler(raw, shape, out=self.buffers.get(name, shape, like))
+        else:
+            out = self.buffers.get(name, shape, like)
+            result = out.copy_(self.resampler(raw, shape))
+            dlh.count_copy(self.copies, "device" if out.is_cuda else "host", out)
+        return autograd.Variable(result, volatile=self.volatile)
 
     def set_targets(self, targets, weights=None):
-        b, d, h, w = tuple(self.cuoutput.size())
-        targets = dlh.as_nda(targets, (0, 2, 3, 1))
-        targets = zoom_like(targets, (b, h, w, d))
-        dlh.assign(self.cutarget, targets, (0, 3, 1, 2))
+        self.cutarget = self._resampled("target", targets)
         assert self.cutarget.size() == self.cuoutput.size()
         if weights is not None:
-            weights = dlh.as_nda(weights, (0, 2, 3, 1))
-            weights = zoom_like(weights, (b, h, w, d))
-            dlh.assign(self.cuweights, weights, (0, 3, 1, 2))
+            self.cuweights = self._resampled("weights", weights)
 
-def ctc_align(prob, target):
-    """Perform CTC alignment on torch sequence batches (using ocrolstm).
+def ctc_align(prob, target, engine="native", processes=None,
+              input_lengths=None, target_lengths=None):
+    """Perform CTC alignment on torch sequence batches.
 
-    Inputs are in BDL format.
+    Inputs are in BDL format. See `ctc.ctc_align` for the available
+    engines and the handling of lengths.
     """
-    import cctc
-    assert dlh.sequence_is_normalized(prob), prob
-    assert dlh.sequence_is_normalized(target), target
+    if dlh.should_validate():
+        assert dlh.sequence_is_normalized(prob, 1), prob
+        assert dlh.sequence_is_normalized(target, 1), target
     # inputs are BDL
-    prob_ = dlh.novar(prob).permute(0, 2, 1).cpu().contiguous()
-    target_ = dlh.novar(target).permute(0, 2, 1).cpu().contiguous()
+    prob_ = dlh.novar(prob).permute(0, 2, 1)
+    target_ = dlh.novar(target).permute(0, 2, 1)
     # prob_ and target_ are both BLD now
     assert prob_.size(0) == target_.size(0), (prob_.size(), target_.size())
     assert prob_.size(2) == target_.size(2), (prob_.size(), target_.size())
     assert prob_.size(1) >= target_.size(1), (prob_.size(), target_.size())
-    result = torch.rand(1)
-    cctc.ctc_align_targets_batch(result, prob_, target_)
+    result = ctc.ctc_align(prob_, target_, engine=engine, processes=processes,
+                           input_lengths=input_lengths, target_lengths=target_lengths)
     return dlh.typeas(result.permute(0, 2, 1).contiguous(), prob)
 
-def sequence_softmax(seq):
+def sequence_softmax(seq, log=False):
     """Given a BDL sequence, computes the softmax for each time step."""
-    b, d, l = seq.size()
-    batch = seq.permute(0, 2, 1).contiguous().view(b*l, d)
-    smbatch = F.softmax(batch)
-    result = smbatch.view(b, l, d).permute(0, 2, 1).contiguous()
-    return result
+    assert seq.dim() == 3, seq.size()
+    return dlh.batched_softmax(seq, 1, log=log)
 
 class Image2SeqTrainer(BasicTrainer):
     """Train image to sequence models using CTC.
 
     This takes images in BHWD order, plus output sequences
     consisting of lists of integers.
+
+    The `ctc_engine` argument selects the CTC alignment engine ("native",
+    "parallel", or "cctc"; see `ctc.ctc_align`), and `ctc_processes` the
+    number of processes for the "parallel" engine.
+
+    For batches of padded, variable-width images (see
+    `buckets.bucketed_batches`), `set_lengths` gives the unpadded
+    widths and target lengths; the length-aware layers of the model
+    then skip the padding, and CTC alignment ignores padded frames.
     """
     def __init__(self, *args, **kw):
+        self.ctc_engine = kw.pop("ctc_engine", "native")
+        self.ctc_processes = kw.pop("ctc_processes", None)
+        self.lengths = None
+        self.target_lengths = None
         BasicTrainer.__init__(self, *args, **kw)
 
+    def set_lengths(self, lengths=None, target_lengths=None):
+        """Set the input widths and target lengths of the following batches.
+
+        These stay in effect until the next call; train_for and
+        eval_for set them from the "lengths" and "target_lengths"
+        fields of each batch.
+        """
+        self.lengths = None if lengths is None else dlh.asnd(lengths)
+        self.target_lengths = None if target_lengths is None else dlh.asnd(target_lengths)
+
+    def set_batch_info(self, batch):
+        self.set_lengths(batch.get("lengths"), batch.get("target_lengths"))
+
+    def shard_info(self, lo, hi):
+        select = lambda x: None if x is None else x[lo:hi]
+        return dict(lengths=select(self.lengths), target_lengths=select(self.target_lengths))
+
+    def collate(self, samples):
+        """Pad HWD images of different heights (sequence lengths) into a batch."""
+        batch = buckets.pad_stack([dlh.asnd(x) for x in samples], 0)
+        dlh.count_copy(self.copies, "host", batch)
+        lengths = np.array([dlh.size(x, 0) for x in samples], "int64")
+        return batch, dict(lengths=lengths)
+
+    def split_outputs(self, outputs, info):
+        """Trim each DL output to the length of its sample."""
+        lengths = info.get("lengths")
+        if lengths is None:
+            return list(outputs)
+        n, l = outputs.shape[2], max(lengths)
+        return [output[:, :int(np.ceil(length * n * 1.0 / l - 1e-6))]
+                for output, length in zip(outputs, lengths)]
+
+    def fractions(self, n):
+        if self.lengths is None:
+            return None
+        assert len(self.lengths) == self.cuinput.size(0), \
+            "lengths do not match the batch (set them with set_batch_info)"
+        return np.asarray(self.lengths, "d") / n
+
     def init_loss(self, loss=None):
         assert loss is None, "Image2SeqTrainer must be trained with BCELoss (default)"
         self.criterion = nn.BCELoss(size_average=False)
@@ -328,17 +1108,32 @@ class Image2SeqTrainer(BasicTrainer):
         logits = self.cuoutput
         b, d, l = logits.size()
         probs = sequence_softmax(logits)
-        assert dlh.sequence_is_normalized(probs), probs
-        ttargets = torch.FloatTensor(targets)
+        ttargets = self.buffers.assign("target", targets, dtype=dlh.novar(probs).type())
         target_b, target_d, target_l = ttargets.size()
         assert b == target_b, (b, target_b)
-        assert dlh.sequence_is_normalized(ttargets), ttargets
-        aligned = ctc_align(probs.cpu(), ttargets.cpu())
-        assert dlh.sequence_is_normalized(aligned)
-        return self.criterion(probs, Variable(self._cuda(aligned)))
+        input_lengths = None
+        if self.lengths is not None:
+            fractions = self.fractions(self.cuinput.size(2))
+            input_lengths = np.clip(np.ceil(fractions * l - 1e-6), 1, l).astype("int64")
+        # ctc_align checks that probs and ttargets are normalized
+        aligned = ctc_align(probs, ttargets, engine=self.ctc_engine,
+                            processes=self.ctc_processes,
+                            input_lengths=input_lengths,
+                            target_lengths=self.target_lengths)
+        aligned = self._cuda(aligned)
+        if input_lengths is not None:
+            # padded frames are aligned to the prediction, so they add no gradient
+            mask = (np.arange(l)[np.newaxis, :] < input_lengths[:, np.newaxis])
+            mask = dlh.typeas(torch.from_numpy(mask[:, np.newaxis, :].astype("f")), aligned)
+            mask = mask.expand_as(aligned)
+            aligned = aligned * mask + dlh.novar(probs) * (1 - mask)
+        if dlh.should_validate():
+            assert dlh.sequence_is_normalized(aligned, 1)
+        return self.criterion(probs, Variable(aligned))
 
     def set_inputs(self, images):
-        dlh.assign(self.cuinput, images, (0, 3, 1, 2))
+        self.cuinput = self._variable("input", images, (0, 3, 1, 2))
+        layers.set_sequence_fractions(self.compute_model(), self.fractions(self.cuinput.size(2)))
 
     def set_targets(self, targets, outputs, weights=None):
         raise Exception("overridden by compute_loss")
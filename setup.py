@@ -18,6 +18,7 @@ assert sys.version_info[0] == 2 and sys.version_info[1] >= 7,\
 
 
 scripts = """
+run-model
 """.split()
 
 setup(